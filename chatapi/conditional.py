@@ -0,0 +1,30 @@
+import hashlib
+from rest_framework.response import Response
+
+
+def make_etag(*parts):
+    # weak: equal versions mean the same content, not the same bytes
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+def matches_etag(header, etag):
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    # weak comparison, as If-None-Match asks for
+    strong = etag[2:] if etag.startswith("W/") else etag
+    return "*" in tags or strong in tags or f"W/{strong}" in tags
+
+
+def conditional(request, etag, respond):
+    # answers 304 when the client holds etag, respond() only runs otherwise;
+    # etag has to be computed before anything respond() reads, so a write
+    # in between makes the next request miss rather than hit stale content
+    if etag is not None and matches_etag(request.META.get("HTTP_IF_NONE_MATCH"), etag):
+        response = Response(status=304)
+    else:
+        response = respond()
+    if etag is not None and response.status_code in (200, 304):
+        response["ETag"] = etag
+    return response
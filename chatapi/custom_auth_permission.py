@@ -1,6 +1,6 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
-from django.utils import timezone
 from django.contrib.auth import authenticate
+from .presence import presence_buffer
 
 
 class IsAuthenticatedCustom(BasePermission):
@@ -12,9 +12,7 @@ class IsAuthenticatedCustom(BasePermission):
             return False
         request.user = user
         if request.user and request.user.is_authenticated:
-            from user_control.models import CustomUser
-            CustomUser.objects.filter(id=request.user.id).update(
-                is_online=timezone.now())
+            presence_buffer.record(request.user.id)
             return True
         return False
 
@@ -25,8 +23,6 @@ class IsAuthenticatedOrReadCustom(BasePermission):
             return True
 
         if request.user and request.user.is_authenticated:
-            from user_control.models import CustomUser
-            CustomUser.objects.filter(id=request.user.id).update(
-                is_online=timezone.now())
+            presence_buffer.record(request.user.id)
             return True
         return False
@@ -0,0 +1,190 @@
+import sqlite3
+
+from django.db import connection, transaction
+
+# the trigram tokenizer first shipped with SQLite 3.34.0
+TRIGRAM_SQLITE_VERSION = (3, 34, 0)
+
+# whether the SQLite library was built with FTS5, per connection alias
+_fts5_support = {}
+
+
+def has_fts5(using):
+    if using.alias not in _fts5_support:
+        with using.cursor() as cursor:
+            cursor.execute("PRAGMA compile_options")
+            options = {row[0] for row in cursor.fetchall()}
+        _fts5_support[using.alias] = "ENABLE_FTS5" in options
+    return _fts5_support[using.alias]
+
+
+# thin wrapper around an SQLite FTS5 table whose rowid mirrors the primary
+# key of the model it indexes; on other databases, or on an SQLite built
+# without FTS5 or too old for the tokenizer, is_available() is False and
+# callers keep using their plain ORM filters
+class FullTextIndex:
+
+    def __init__(self, table, columns, unindexed=(), tokenize="trigram",
+                 min_term_length=3):
+        self.table = table
+        self.columns = tuple(columns)
+        self.unindexed = tuple(unindexed)
+        self.tokenize = tokenize
+        # the trigram tokenizer cannot match anything shorter than this,
+        # word tokenizers match terms as prefixes instead
+        self.min_term_length = min_term_length if tokenize == "trigram" else 1
+        self.prefix = tokenize != "trigram"
+
+    def is_available(self, using=None):
+        using = using or connection
+        if using.vendor != "sqlite" or not has_fts5(using):
+            return False
+        return (self.tokenize != "trigram" or
+                sqlite3.sqlite_version_info >= TRIGRAM_SQLITE_VERSION)
+
+    def create(self, using=None):
+        columns = list(self.columns) + [
+            f"{column} UNINDEXED" for column in self.unindexed]
+        with (using or connection).cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+                f"{', '.join(columns)}, tokenize='{self.tokenize}')")
+
+    def drop(self, using=None):
+        with (using or connection).cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    @property
+    def changes_table(self):
+        return f"{self.table}_changes"
+
+    def rebuild(self, chunks, using=None):
+        # fill a shadow table chunk by chunk, each chunk in its own short
+        # transaction, and only swap it in once it is complete so searches
+        # keep working against the old index meanwhile. writers keep updating
+        # the live table and note the rowids they touch in a change log, the
+        # swap copies those rows over from the live table first
+        shadow = FullTextIndex(
+            f"{self.table}_rebuild", self.columns, self.unindexed, self.tokenize)
+        using = using or connection
+        self.create(using)
+        shadow.drop(using)
+        shadow.create(using)
+        with using.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.changes_table}")
+            cursor.execute(
+                f"CREATE TABLE {self.changes_table} (rowid INTEGER PRIMARY KEY)")
+
+        try:
+            total = 0
+            for rows in chunks:
+                with transaction.atomic(using=using.alias):
+                    shadow.insert_many(rows, using)
+                total += len(rows)
+
+            names = ", ".join(self.columns + self.unindexed)
+            changed = f"SELECT rowid FROM {self.changes_table}"
+            with transaction.atomic(using=using.alias):
+                with using.cursor() as cursor:
+                    # the first write takes the write lock, no writer gets
+                    # in between the replay and the swap
+                    cursor.execute(
+                        f"DELETE FROM {shadow.table} WHERE rowid IN ({changed})")
+                    cursor.execute(
+                        f"INSERT INTO {shadow.table} (rowid, {names}) "
+                        f"SELECT rowid, {names} FROM {self.table} "
+                        f"WHERE rowid IN ({changed})")
+                    cursor.execute(f"DROP TABLE {self.changes_table}")
+                self.drop(using)
+                with using.cursor() as cursor:
+                    cursor.execute(
+                        f"ALTER TABLE {shadow.table} RENAME TO {self.table}")
+        except BaseException:
+            shadow.drop(using)
+            with using.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {self.changes_table}")
+            raise
+        return total
+
+    def log_changes(self, rowids, using):
+        # only while a rebuild is running, which is when its change log exists
+        with using.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                [self.changes_table])
+            if cursor.fetchone() is None:
+                return
+            cursor.executemany(
+                f"INSERT OR IGNORE INTO {self.changes_table} (rowid) VALUES (%s)",
+                [(rowid, ) for rowid in rowids])
+
+    def insert_many(self, rows, using=None):
+        names = self.columns + self.unindexed
+        placeholders = ", ".join(["%s"] * (len(names) + 1))
+        with (using or connection).cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, {', '.join(names)}) "
+                f"VALUES ({placeholders})",
+                [(rowid, *[values.get(name) for name in names])
+                 for rowid, values in rows])
+
+    def upsert_many(self, rows, using=None):
+        # rows are (rowid, {column: value}) pairs
+        rows = list(rows)
+        if not rows:
+            return
+        using = using or connection
+        # starting with a write holds the write lock for the change log check
+        with transaction.atomic(using=using.alias):
+            with using.cursor() as cursor:
+                cursor.executemany(
+                    f"DELETE FROM {self.table} WHERE rowid = %s",
+                    [(rowid, ) for rowid, _ in rows])
+            self.insert_many(rows, using)
+            self.log_changes([rowid for rowid, _ in rows], using)
+
+    def upsert(self, rowid, values, using=None):
+        self.upsert_many([(rowid, values)], using=using)
+
+    def delete_many(self, rowids, using=None):
+        rowids = list(rowids)
+        if not rowids:
+            return
+        using = using or connection
+        with transaction.atomic(using=using.alias):
+            with using.cursor() as cursor:
+                cursor.executemany(
+                    f"DELETE FROM {self.table} WHERE rowid = %s",
+                    [(rowid, ) for rowid in rowids])
+            self.log_changes(rowids, using)
+
+    def delete(self, rowid, using=None):
+        self.delete_many([rowid], using)
+
+    def can_search(self, terms):
+        return bool(terms) and self.is_available() and all(
+            len(term) >= self.min_term_length for term in terms)
+
+    def match_query(self, terms):
+        # every term is matched as a phrase (a substring with the trigram
+        # tokenizer) in any column, all terms must match
+        suffix = "*" if self.prefix else ""
+        return " AND ".join(
+            '"%s"%s' % (term.replace('"', '""'), suffix) for term in terms)
+
+    def rowids_sql(self):
+        # use as RawSQL(sql, [match_query]) inside an __in lookup
+        return f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s"
+
+    def rank_sql(self, rowid_column):
+        # correlated bm25 rank of the row matching rowid_column, lower is better
+        return (
+            f"SELECT rank FROM {self.table} WHERE {self.table} MATCH %s "
+            f"AND rowid = {rowid_column}")
+
+    def snippet_sql(self, rowid_column, column=0, tokens=12):
+        # correlated highlighted excerpt of the row matching rowid_column
+        return (
+            f"SELECT snippet({self.table}, {column}, '<b>', '</b>', '...', "
+            f"{tokens}) FROM {self.table} WHERE {self.table} MATCH %s "
+            f"AND rowid = {rowid_column}")
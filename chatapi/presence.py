@@ -0,0 +1,120 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+# collects last-seen times in memory and writes them to CustomUser.is_online
+# with one bulk update every PRESENCE_FLUSH_INTERVAL seconds or once
+# PRESENCE_FLUSH_SIZE users are pending, whichever comes first; a background
+# thread flushes on the interval even when no further request comes in
+class PresenceBuffer:
+
+    def __init__(self, interval=None, max_users=None):
+        self.interval = interval
+        self.max_users = max_users
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def get_interval(self):
+        if self.interval is not None:
+            return self.interval
+        return getattr(settings, "PRESENCE_FLUSH_INTERVAL", 30)
+
+    def get_max_users(self):
+        if self.max_users is not None:
+            return self.max_users
+        return getattr(settings, "PRESENCE_FLUSH_SIZE", 100)
+
+    def record(self, user_id):
+        with self._lock:
+            self._pending[user_id] = timezone.now()
+            due = len(self._pending) >= self.get_max_users() or \
+                time.monotonic() - self._last_flush >= self.get_interval()
+
+        # started on first use, so a forking server starts it in every worker
+        if self._thread is None and getattr(settings, "PRESENCE_FLUSH_THREAD", True):
+            self.start()
+        if due:
+            self.flush()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            thread = self._thread = threading.Thread(
+                target=self._run, name="presence-flush", daemon=True)
+        thread.start()
+
+    def stop(self):
+        # stops the background thread and writes whatever is still pending
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+        return self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.get_interval()):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flushing presence failed")
+            finally:
+                # the thread's own connection, not kept open between flushes
+                connection.close()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+
+        if not pending:
+            return 0
+
+        from user_control.models import CustomUser
+        try:
+            return CustomUser.objects.filter(id__in=pending.keys()).update(
+                is_online=Case(
+                    *[When(id=user_id, then=Value(seen))
+                      for user_id, seen in pending.items()],
+                    output_field=DateTimeField()
+                ))
+        except DatabaseError:
+            # put the entries back so the next flush retries them, keeping
+            # any newer timestamp recorded in the meantime
+            with self._lock:
+                for user_id, seen in pending.items():
+                    if self._pending.get(user_id, seen) <= seen:
+                        self._pending[user_id] = seen
+            return 0
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+
+presence_buffer = PresenceBuffer()
+
+
+@atexit.register
+def flush_on_shutdown():
+    try:
+        presence_buffer.stop()
+    except Exception:
+        pass
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from decouple import config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -38,6 +39,19 @@ REST_FRAMEWORK = {
     "PAGE_SIZE": 20,
 }
 
+# in-process cache of authenticated users, keyed by access token
+PRINCIPAL_CACHE_SIZE = 1024
+PRINCIPAL_CACHE_TTL = 300  # seconds, never longer than the token's exp
+
+# in-memory denylist of access tokens revoked on logout
+TOKEN_DENYLIST_SYNC_INTERVAL = 30  # seconds between loads of new revocations
+TOKEN_DENYLIST_BLOOM_BITS = 0  # e.g. 2 ** 20 to check huge denylists through a bloom filter
+
+# is_online writes are buffered and flushed in bulk, whichever comes first
+PRESENCE_FLUSH_INTERVAL = 30  # seconds
+PRESENCE_FLUSH_SIZE = 100  # users
+PRESENCE_FLUSH_THREAD = True  # also flush on the interval from a background thread
+
 
 # Application definition
 
@@ -68,6 +82,8 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'chatapi.urls'
 
+TEST_RUNNER = 'chatapi.test_runner.TestRunner'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -178,7 +194,69 @@ AWS_S3_OBJECT_PARAMETERS = {
 }
 
 
-DEFAULT_FILE_STORAGE = 'chatapi.storage_backends.MediaStorage'
-
+# media lives in MediaStorage (S3), recently used files are also kept on
+# local disk; the least recently used go once MEDIA_CACHE_MAX_SIZE is reached
+DEFAULT_FILE_STORAGE = 'chatapi.storage_backends.CachedStorage'
+MEDIA_CACHE_BACKEND = 'chatapi.storage_backends.MediaStorage'
+MEDIA_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'chatapi-media')
+MEDIA_CACHE_MAX_SIZE = 1024 ** 3
+MEDIA_CACHE_MAX_FILE_SIZE = 32 * 1024 ** 2  # larger files are always read from S3
+MEDIA_CACHE_VERIFY = False  # hash local copies on every open
+
+# serialized uploads reuse storage URLs per object name; signed ones are kept
+# for at most half of AWS_QUERYSTRING_EXPIRE
+MEDIA_URL_CACHE_SIZE = 10000
+MEDIA_URL_CACHE_TTL = 3600  # seconds
+
+# the stock handlers, hashing files while they are received so identical
+# uploads are stored once
+FILE_UPLOAD_HANDLERS = [
+    'message_control.uploads.DigestMemoryFileUploadHandler',
+    'message_control.uploads.DigestTemporaryFileUploadHandler',
+]
 
-SOCKET_SERVER = config("SOCKET_SERVER")
+# message sync hands out changes once they are SYNC_SETTLE_TIME seconds old,
+# at most SYNC_PAGE_SIZE of them per poll
+SYNC_SETTLE_TIME = 2
+SYNC_PAGE_SIZE = 200
+
+# attachment downloads are streamed in DOWNLOAD_CHUNK_SIZE blocks; local
+# files go to the web server instead when MEDIA_SENDFILE_HEADER is set,
+# 'X-Sendfile' with the file's path or 'X-Accel-Redirect' (nginx) with
+# MEDIA_SENDFILE_PREFIX and its name
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MEDIA_SENDFILE_HEADER = None
+MEDIA_SENDFILE_PREFIX = '/protected-media/'
+
+# chunked uploads are assembled in CHUNKED_UPLOAD_DIR before being saved to
+# the storage, on S3 every chunk is sent on as a multipart part instead
+CHUNKED_UPLOAD_DIR = os.path.join(tempfile.gettempdir(), 'chatapi-uploads')
+CHUNKED_UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 ** 2  # and at least 5MB on S3
+
+# scaled down copies of uploaded images, made in a pool of worker processes
+# (0 makes them inline, after the upload's transaction commits)
+THUMBNAIL_SIZES = {
+    'thumbnail': (128, 128),
+    'preview': (640, 640),
+}
+THUMBNAIL_PROCESSES = 2
+
+
+# messages are pushed to the receiver's websockets served by chatapi.asgi;
+# REALTIME_BROKER is the dotted path of a pub/sub broker class shared by
+# all processes (message_control.realtime.LocalBroker for a single process)
+REALTIME_BROKER = None
+REALTIME_QUEUE_SIZE = 100  # pending messages per connection
+
+# external socket server for notifications whose receiver has no websocket
+# on this process; unused, and may be left empty, when REALTIME_BROKER is set
+SOCKET_SERVER = config("SOCKET_SERVER", default="")
+
+# notifications are posted to SOCKET_SERVER from background threads
+SOCKET_DISPATCH_WORKERS = 2
+SOCKET_QUEUE_SIZE = 1000  # further notifications are dropped and counted
+SOCKET_BATCH_SIZE = 50
+SOCKET_MAX_RETRIES = 3
+SOCKET_RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+SOCKET_TIMEOUT = 2  # seconds
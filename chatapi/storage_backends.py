@@ -1,6 +1,261 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage, get_storage_class
+from django.utils._os import safe_join
 from storages.backends.s3boto3 import S3Boto3Storage
 
+BLOCK_SIZE = 64 * 1024
+DIGEST_SUFFIX = ".sha256"
+PARTIAL_SUFFIX = ".part"
+
 
 class MediaStorage(S3Boto3Storage):
     location = 'media'
     file_overwrite = False
+
+
+def get_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+# the backend (MediaStorage) stays the source of truth; a size-bounded
+# directory on local disk keeps copies of recently used files, filled on
+# first read and on save, so hot media never leaves the machine. every copy
+# has its sha256 next to it, checked on open when verify is on and by check()
+class CachedStorage(Storage):
+
+    def __init__(self, backend=None, location=None, max_size=None,
+                 max_file_size=None, verify=None):
+        backend = backend or getattr(
+            settings, "MEDIA_CACHE_BACKEND", "chatapi.storage_backends.MediaStorage")
+        self.backend = get_storage_class(backend)() if isinstance(backend, str) else backend
+        self.location = location or getattr(
+            settings, "MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "chatapi-media"))
+        self.max_size = max_size or getattr(
+            settings, "MEDIA_CACHE_MAX_SIZE", 1024 ** 3)
+        self.max_file_size = max_file_size or getattr(
+            settings, "MEDIA_CACHE_MAX_FILE_SIZE", 32 * 1024 ** 2)
+        self.verify = verify if verify is not None else getattr(
+            settings, "MEDIA_CACHE_VERIFY", False)
+        self.hits = 0
+        self.misses = 0
+        self.used = 0
+        # name -> (size, digest), least recently used first; read from the
+        # directory on first use so a restart keeps the cache warm
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def get_path(self, name):
+        return safe_join(self.location, name)
+
+    def save(self, name, content, max_length=None):
+        # write through: the backend first, then the local copy
+        name = self.backend.save(name, content, max_length=max_length)
+        size = getattr(content, "size", None)
+        if size is not None and size <= self.max_file_size:
+            try:
+                self.fill(name, content)
+            except (OSError, ValueError):
+                self.discard(name)
+        return name
+
+    def _open(self, name, mode="rb"):
+        if any(flag in mode for flag in "wa+"):
+            self.discard(name)
+            return self.backend.open(name, mode)
+
+        path = self.get_path(name)
+        if self.lookup(name, path):
+            try:
+                return File(open(path, mode), name)
+            except FileNotFoundError:
+                pass
+
+        source = self.backend.open(name, mode)
+        if source.size > self.max_file_size:
+            return source
+        try:
+            with source:
+                self.fill(name, source)
+            return File(open(path, mode), name)
+        except OSError:
+            # evicted straight away by another thread, or the disk is full
+            return self.backend.open(name, mode)
+
+    def lookup(self, name, path):
+        with self._lock:
+            self._load()
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+
+        valid = False
+        if entry is not None:
+            size, digest = entry
+            try:
+                valid = os.path.getsize(path) == size and (
+                    not self.verify or get_digest(path) == digest)
+                if valid:
+                    # the mtime orders the entries when the directory is read again
+                    os.utime(path)
+            except OSError:
+                valid = False
+            if not valid:
+                self.discard(name)
+
+        with self._lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return valid
+
+    def fill(self, name, content):
+        path = self.get_path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # written aside and renamed, readers never see a partial copy
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, partial = tempfile.mkstemp(suffix=PARTIAL_SUFFIX, dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as target:
+                for chunk in content.chunks(BLOCK_SIZE):
+                    target.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+            with open(path + DIGEST_SUFFIX, "w") as digest_file:
+                digest_file.write(sha256.hexdigest())
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        with self._lock:
+            self._load()
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.used -= previous[0]
+            self._entries[name] = (size, sha256.hexdigest())
+            self.used += size
+            self._evict()
+
+    def discard(self, name):
+        with self._lock:
+            self._load()
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self.used -= entry[0]
+            self._remove(name)
+
+    def check(self):
+        # hashes every local copy, dropping the ones that no longer match
+        with self._lock:
+            self._load()
+            entries = list(self._entries.items())
+        dropped = []
+        for name, (size, digest) in entries:
+            try:
+                valid = get_digest(self.get_path(name)) == digest
+            except OSError:
+                valid = False
+            if not valid:
+                self.discard(name)
+                dropped.append(name)
+        return len(entries), dropped
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                "files": len(self._entries),
+                "size": self.used,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        found = []
+        for root, _, filenames in os.walk(self.location):
+            for filename in filenames:
+                if filename.endswith((DIGEST_SUFFIX, PARTIAL_SUFFIX)):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    with open(path + DIGEST_SUFFIX) as digest_file:
+                        digest = digest_file.read()
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                name = os.path.relpath(path, self.location).replace(os.sep, "/")
+                found.append((stat.st_mtime, name, stat.st_size, digest))
+        found.sort()
+        self._entries = OrderedDict(
+            (name, (size, digest)) for _, name, size, digest in found)
+        self.used = sum(size for _, _, size, _ in found)
+        self._evict()
+
+    def _evict(self):
+        while self.used > self.max_size and self._entries:
+            name, (size, _) = self._entries.popitem(last=False)
+            self.used -= size
+            self._remove(name)
+
+    def _remove(self, name):
+        path = self.get_path(name)
+        for filename in (path, path + DIGEST_SUFFIX):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def delete(self, name):
+        self.backend.delete(name)
+        self.discard(name)
+
+    def size(self, name):
+        with self._lock:
+            self._load()
+            entry = self._entries.get(name)
+        return entry[0] if entry is not None else self.backend.size(name)
+
+    def exists(self, name):
+        return self.backend.exists(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def url(self, name):
+        return self.backend.url(name)
+
+    def get_valid_name(self, name):
+        return self.backend.get_valid_name(name)
+
+    def get_available_name(self, name, max_length=None):
+        return self.backend.get_available_name(name, max_length=max_length)
+
+    def generate_filename(self, filename):
+        return self.backend.generate_filename(filename)
+
+    def get_accessed_time(self, name):
+        return self.backend.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.backend.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.backend.get_modified_time(name)
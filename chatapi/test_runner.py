@@ -0,0 +1,22 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from .presence import presence_buffer
+
+
+# tests flush the presence buffer themselves; its background thread would
+# write next to the test's transaction, and what is left at exit must not
+# reach the real database once the test database is gone
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.presence_settings = override_settings(PRESENCE_FLUSH_THREAD=False)
+        self.presence_settings.enable()
+
+    def teardown_databases(self, old_config, **kwargs):
+        presence_buffer.clear()
+        super().teardown_databases(old_config, **kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        self.presence_settings.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1 @@
+default_app_config = 'message_control.apps.MessageControlConfig'
@@ -1,5 +1,5 @@
 from django.contrib import admin
 
-from .models import Message, MessageAttachment
+from .models import ChunkedUpload, Conversation, Message, MessageAttachment, ReadCursor, UnreadCounter, UnreadTotal
 
-admin.site.register((Message, MessageAttachment))
+admin.site.register((ChunkedUpload, Conversation, Message, MessageAttachment, ReadCursor, UnreadCounter, UnreadTotal))
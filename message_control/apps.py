@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MessageControlConfig(AppConfig):
     name = 'message_control'
+
+    def ready(self):
+        from . import signals  # noqa: F401
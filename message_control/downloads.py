@@ -0,0 +1,141 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+from django.conf import settings
+from chatapi.conditional import matches_etag
+from django.http import HttpResponse, StreamingHttpResponse
+from storages.backends.s3boto3 import S3Boto3Storage
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    # a single byte range as inclusive (start, end); None serves the whole
+    # file, ValueError when none of it can be served
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        suffix = int(end)
+        if suffix == 0:
+            raise ValueError("empty suffix range")
+        return max(size - suffix, 0), size - 1
+
+    start = int(start)
+    if start >= size:
+        raise ValueError("range starts past the end")
+    end = min(int(end), size - 1) if end else size - 1
+    if end < start:
+        return None
+    return start, end
+
+
+def iter_range(storage, name, start, length, size, chunk_size):
+    backend = getattr(storage, "backend", storage)
+    if isinstance(backend, S3Boto3Storage) and size > getattr(storage, "max_file_size", 0):
+        # a ranged GET read as it arrives, S3 files opened through the
+        # storage are downloaded whole first; only worth it for the ones
+        # the local media cache does not keep
+        key = backend._normalize_name(backend._clean_name(name))
+        body = backend.bucket.Object(key).get(
+            Range=f"bytes={start}-{start + length - 1}")["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+        return
+
+    with storage.open(name, "rb") as file:
+        file.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def get_local_path(storage, name):
+    try:
+        return storage.path(name)
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def get_etag(upload):
+    # the content of an upload never changes
+    if upload.digest:
+        return f'"{upload.digest}"'
+    return f'"{upload.id}-{int(upload.created_at.timestamp())}"'
+
+
+def get_disposition(name):
+    filename = os.path.basename(name)
+    try:
+        filename.encode("ascii")
+        return 'attachment; filename="{}"'.format(filename.replace('"', '\\"'))
+    except UnicodeEncodeError:
+        return "attachment; filename*=utf-8''{}".format(quote(filename))
+
+
+def set_headers(response, headers):
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def serve_upload(request, upload):
+    name = upload.file_upload.name
+    storage = upload.file_upload.storage
+    etag = get_etag(upload)
+
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private",
+    }
+    if matches_etag(request.META.get("HTTP_IF_NONE_MATCH"), etag):
+        return set_headers(HttpResponse(status=304), headers)
+
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    headers["Content-Disposition"] = get_disposition(name)
+
+    # local files are handed to the web server, which does ranges itself
+    sendfile_header = getattr(settings, "MEDIA_SENDFILE_HEADER", None)
+    path = get_local_path(storage, name) if sendfile_header else None
+    if path is not None:
+        response = HttpResponse(content_type=content_type)
+        if sendfile_header == "X-Accel-Redirect":
+            prefix = getattr(settings, "MEDIA_SENDFILE_PREFIX", "/protected-media/")
+            response[sendfile_header] = prefix + quote(name)
+        else:
+            response[sendfile_header] = path
+        return set_headers(response, headers)
+
+    size = storage.size(name)
+    byte_range = None
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range or if_range == etag:
+        try:
+            byte_range = parse_range(request.META.get("HTTP_RANGE"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1
+    chunk_size = getattr(settings, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+    response = StreamingHttpResponse(
+        iter_range(storage, name, start, length, size, chunk_size) if length else iter(()),
+        status=206 if byte_range else 200, content_type=content_type)
+    response["Content-Length"] = str(length)
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return set_headers(response, headers)
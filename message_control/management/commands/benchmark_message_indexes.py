@@ -0,0 +1,145 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from message_control.models import Message
+from user_control.models import CustomUser
+
+BENCHMARKED_INDEXES = ("message_conversation_idx", "message_unread_idx")
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the messages table inside a transaction that is rolled back "
+        "and compare query plans and timings of the hot message queries "
+        "with and without the composite indexes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        self.repeat = options["repeat"]
+        rng = random.Random(0)
+
+        with transaction.atomic():
+            user_ids = self.seed_users(options["users"])
+            self.seed_messages(
+                rng, user_ids, options["rows"], options["batch_size"])
+
+            user_id, peer_id = rng.sample(user_ids, 2)
+            queries = self.get_queries(rng, user_ids, user_id, peer_id)
+
+            indexes = [index for index in Message._meta.indexes
+                       if index.name in BENCHMARKED_INDEXES]
+            # DDL is issued directly so it stays inside the rolled back
+            # transaction
+            schema_editor = connection.schema_editor()
+            for index in indexes:
+                schema_editor.execute(index.remove_sql(Message, schema_editor))
+            self.analyze()
+            before = self.run_queries("without indexes", queries)
+
+            for index in indexes:
+                schema_editor.execute(index.create_sql(Message, schema_editor))
+            self.analyze()
+            after = self.run_queries("with indexes", queries)
+
+            self.stdout.write("\nsummary (median ms)")
+            for name in queries:
+                self.stdout.write(
+                    f"  {name:<16} {before[name]:>10.2f} -> {after[name]:>10.2f}")
+
+            transaction.set_rollback(True)
+
+    def seed_users(self, count):
+        now = timezone.now()
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f"benchmark_{i}", email=f"benchmark_{i}@example.com",
+                       password="!", is_online=now)
+            for i in range(count)
+        ])
+        return list(CustomUser.objects.filter(
+            username__startswith="benchmark_").values_list("id", flat=True))
+
+    def seed_messages(self, rng, user_ids, rows, batch_size):
+        table = connection.ops.quote_name(Message._meta.db_table)
+        sql = (
+            f"INSERT INTO {table} (sender_id, receiver_id, message, is_read, "
+            "conversation_key, created_at, updated_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)"
+        )
+        start = timezone.now() - timedelta(seconds=rows)
+        started = time.perf_counter()
+
+        with connection.cursor() as cursor:
+            for offset in range(0, rows, batch_size):
+                batch = []
+                for i in range(offset, min(offset + batch_size, rows)):
+                    sender_id, receiver_id = rng.sample(user_ids, 2)
+                    created_at = start + timedelta(seconds=i)
+                    batch.append((
+                        sender_id, receiver_id, "benchmark message",
+                        rng.random() < 0.9,
+                        Message.get_conversation_key(sender_id, receiver_id),
+                        created_at, created_at,
+                    ))
+                cursor.executemany(sql, batch)
+
+        self.stdout.write(
+            f"seeded {rows} messages in {time.perf_counter() - started:.1f}s")
+
+    def get_queries(self, rng, user_ids, user_id, peer_id):
+        conversation_key = Message.get_conversation_key(user_id, peer_id)
+        sender_ids = rng.sample(user_ids, min(20, len(user_ids)))
+        page_ids = list(Message.objects.filter(
+            receiver_id=user_id).values_list("id", flat=True)[:20])
+
+        return {
+            "thread_page": lambda: Message.objects.filter(
+                conversation_key=conversation_key)[:20],
+            "thread_count": lambda: Message.objects.filter(
+                conversation_key=conversation_key).values("id"),
+            "legacy_thread": lambda: Message.objects.filter(
+                Q(sender_id=user_id, receiver_id=peer_id) |
+                Q(sender_id=peer_id, receiver_id=user_id)).distinct()[:20],
+            "unread_count": lambda: Message.objects.unread(user_id, [peer_id]),
+            "unread_grouped": lambda: Message.objects.unread(
+                user_id, sender_ids).order_by().values("sender_id"),
+            "read_messages": lambda: Message.objects.filter(id__in=page_ids),
+        }
+
+    def run_queries(self, label, queries):
+        self.stdout.write(f"\n== {label}")
+        medians = {}
+        for name, build in queries.items():
+            self.stdout.write(f"-- {name}\n{build().explain()}")
+
+            timings = []
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                if name == "read_messages":
+                    with transaction.atomic():
+                        build().update(is_read=True)
+                        transaction.set_rollback(True)
+                elif name in ("thread_count", "unread_count"):
+                    build().count()
+                else:
+                    list(build())
+                timings.append((time.perf_counter() - started) * 1000)
+
+            medians[name] = statistics.median(timings)
+            self.stdout.write(f"   median {medians[name]:.2f}ms")
+        return medians
+
+    def analyze(self):
+        if connection.vendor in ("sqlite", "postgresql"):
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
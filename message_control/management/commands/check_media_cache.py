@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from message_control.views import get_upload_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Hash every file in the local media cache and drop the copies that "
+        "no longer match their recorded digest."
+    )
+
+    def handle(self, *args, **options):
+        storage = get_upload_storage()
+        if not hasattr(storage, "check"):
+            raise CommandError("the media storage has no local cache")
+
+        checked, dropped = storage.check()
+        for name in dropped:
+            self.stderr.write(f"dropped {name}")
+        self.stdout.write(f"checked {checked} cached files, dropped {len(dropped)}")
@@ -0,0 +1,31 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from message_control.models import ChunkedUpload
+from message_control.uploads import get_chunk_store
+from message_control.views import get_upload_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Abort chunked uploads that received nothing for a while, removing "
+        "their partial data, and forget finished ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=int, default=24)
+
+    def handle(self, *args, **options):
+        storage = get_upload_storage()
+        store = get_chunk_store(storage)
+        stale = ChunkedUpload.objects.filter(
+            updated_at__lt=timezone.now() - timedelta(hours=options["hours"]))
+
+        count = 0
+        for upload in stale.filter(file_upload__isnull=True).iterator():
+            store.abort(upload, storage)
+            upload.delete()
+            count += 1
+        # finished ones only keep their bookkeeping row, the file stays
+        stale.delete()
+        self.stdout.write(f"cleared {count} uploads")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from message_control.models import GenericFileUpload
+from message_control.thumbnails import is_image, thumbnail_generator
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate the thumbnail and preview variants of uploaded images that "
+        "do not have them yet, a chunk of uploads at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=100)
+        parser.add_argument(
+            "--force", action="store_true", help="Regenerate existing variants too.")
+
+    def handle(self, *args, **options):
+        last_id = 0
+        total = 0
+        while True:
+            chunk = list(GenericFileUpload.objects.filter(id__gt=last_id).order_by(
+                "id").values_list("id", "file_upload", "variants")[:options["chunk_size"]])
+            if not chunk:
+                break
+            upload_ids = [upload_id for upload_id, name, variants in chunk
+                          if is_image(name) and (options["force"] or not variants)]
+            total += thumbnail_generator.generate_many(upload_ids, options["force"])
+            last_id = chunk[-1][0]
+
+        self.stdout.write(f"generated variants of {total} uploads")
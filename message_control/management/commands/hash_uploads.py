@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from message_control.models import GenericFileUpload, MessageAttachment
+from message_control.uploads import get_digest
+from user_control.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Hash uploads stored before content addressing and merge the ones "
+        "holding identical content into a single upload."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        last_id = 0
+        hashed = merged = 0
+        while True:
+            chunk = list(GenericFileUpload.objects.filter(
+                id__gt=last_id, digest__isnull=True).order_by("id")[:options["chunk_size"]])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            for upload in chunk:
+                try:
+                    with upload.file_upload.open("rb") as file:
+                        digest = get_digest(file)
+                except (FileNotFoundError, OSError):
+                    self.stderr.write(f"could not read upload {upload.id}")
+                    continue
+
+                if self.merge(upload, digest):
+                    merged += 1
+                hashed += 1
+
+        self.stdout.write(f"hashed {hashed} uploads, merged {merged} duplicates")
+
+    @staticmethod
+    def merge(upload, digest):
+        with transaction.atomic():
+            original = GenericFileUpload.objects.select_for_update().filter(
+                digest=digest).first()
+            if original is None:
+                GenericFileUpload.objects.filter(id=upload.id).update(digest=digest)
+                return False
+
+            # everything pointing at the duplicate moves to the original
+            MessageAttachment.objects.filter(attachment_id=upload.id).update(
+                attachment_id=original.id)
+            UserProfile.objects.filter(profile_picture_id=upload.id).update(
+                profile_picture_id=original.id)
+            GenericFileUpload.objects.filter(id=original.id).update(
+                ref_count=F("ref_count") + upload.ref_count)
+            GenericFileUpload.bump_referrers([original.id])
+            upload.delete()
+            if upload.file_upload.name != original.file_upload.name:
+                transaction.on_commit(upload.delete_files)
+        return True
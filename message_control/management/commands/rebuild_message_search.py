@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from message_control.search import message_index, rebuild_message_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the full-text index used by the message search in chunks, "
+        "swapping it in once complete."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not message_index.is_available():
+            raise CommandError(
+                "Message full-text search is only available on SQLite.")
+
+        total = rebuild_message_index(options["chunk_size"])
+        self.stdout.write(f"indexed {total} messages")
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from message_control.models import UnreadCounter
+from user_control.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the unread counters and totals from the messages, a "
+        "chunk of receivers at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        last_id = 0
+        users = fixed = 0
+        while True:
+            user_ids = list(CustomUser.objects.filter(id__gt=last_id).order_by(
+                "id").values_list("id", flat=True)[:options["chunk_size"]])
+            if not user_ids:
+                break
+            fixed += UnreadCounter.reconcile(user_ids)
+            users += len(user_ids)
+            last_id = user_ids[-1]
+
+        self.stdout.write(
+            f"reconciled unread counters of {users} users, {fixed} corrected")
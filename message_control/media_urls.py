@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+
+def get_lifetime(storage):
+    # seconds a URL of the storage stays valid, None when it is unsigned
+    storage = getattr(storage, "backend", storage)
+    if not getattr(storage, "querystring_auth", False):
+        return None
+    if getattr(storage, "custom_domain", None) and not getattr(storage, "cloudfront_signer", None):
+        # S3Boto3Storage serves custom domains without signing
+        return None
+    return getattr(storage, "querystring_expire", None)
+
+
+# bounded LRU cache of storage URLs keyed by object name; a signed URL is
+# handed out for at most half its lifetime, so clients always get one with
+# time left on it
+class MediaUrlCache:
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or getattr(
+            settings, "MEDIA_URL_CACHE_SIZE", 10000)
+        self.ttl = ttl or getattr(settings, "MEDIA_URL_CACHE_TTL", 3600)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_ttl(self, storage):
+        lifetime = get_lifetime(storage)
+        if lifetime is None:
+            return self.ttl
+        return min(self.ttl, lifetime / 2)
+
+    def resolve_many(self, storage, names):
+        now = time.monotonic()
+        urls = {}
+        with self._lock:
+            for name in set(names):
+                entry = self._entries.get(name)
+                if entry is None or entry[1] <= now:
+                    continue
+                self._entries.move_to_end(name)
+                urls[name] = entry[0]
+            missing = {name for name in names if name not in urls}
+            self.hits += len(urls)
+            self.misses += len(missing)
+
+        if not missing:
+            return urls
+
+        # generated outside the lock, signing may call into boto
+        expires = now + self.get_ttl(storage)
+        generated = {name: storage.url(name) for name in missing}
+        with self._lock:
+            for name, url in generated.items():
+                self._entries[name] = (url, expires)
+                self._entries.move_to_end(name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        urls.update(generated)
+        return urls
+
+    def discard(self, names):
+        with self._lock:
+            for name in names:
+                self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+media_url_cache = MediaUrlCache()
+
+
+def prefetch_urls(uploads):
+    # resolves the URLs of every upload of a response in one pass, the
+    # serializer then reads them from upload.urls
+    uploads = [upload for upload in uploads
+               if upload is not None and not hasattr(upload, "urls")]
+    if not uploads:
+        return
+
+    names = []
+    for upload in uploads:
+        if upload.file_upload:
+            names.append(upload.file_upload.name)
+        names.extend(upload.variants.values())
+
+    storage = uploads[0].file_upload.storage
+    urls = media_url_cache.resolve_many(storage, names)
+    for upload in uploads:
+        upload.urls = {
+            "file_upload": urls.get(upload.file_upload.name) if upload.file_upload else None,
+            "variants": {variant: urls[name] for variant, name in upload.variants.items()},
+        }
+
+
+def get_urls(upload):
+    prefetch_urls([upload])
+    return upload.urls
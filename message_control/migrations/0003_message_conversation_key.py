@@ -0,0 +1,40 @@
+# Generated by Django 3.1.6 on 2026-10-18 10:46
+
+from django.db import migrations, models
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_conversation_keys(apps, schema_editor):
+    Message = apps.get_model('message_control', 'Message')
+    last_id = 0
+    while True:
+        chunk = list(Message.objects.filter(id__gt=last_id).order_by('id').only(
+            'id', 'sender_id', 'receiver_id')[:BACKFILL_CHUNK_SIZE])
+        if not chunk:
+            break
+        for message in chunk:
+            low, high = sorted((message.sender_id, message.receiver_id))
+            message.conversation_key = f"{low}:{high}"
+        Message.objects.bulk_update(chunk, ['conversation_key'])
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0002_auto_20210220_1211'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=50),
+        ),
+        migrations.RunPython(backfill_conversation_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', '-created_at'], name='message_conversation_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.6 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0003_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(is_read=False), fields=['receiver', 'sender'], name='message_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+from chatapi.fts import FullTextIndex
+
+message_index = FullTextIndex(
+    'message_control_message_search', ('message', ),
+    tokenize='unicode61 remove_diacritics 2')
+
+
+def create_message_index(apps, schema_editor):
+    if not message_index.is_available(schema_editor.connection):
+        return
+    message_index.create(schema_editor.connection)
+
+    Message = apps.get_model('message_control', 'Message')
+    last_id = 0
+    while True:
+        chunk = list(Message.objects.filter(id__gt=last_id).order_by(
+            'id').values_list('id', 'message')[:1000])
+        if not chunk:
+            break
+        message_index.insert_many([
+            (message_id, {'message': text}) for message_id, text in chunk if text
+        ], schema_editor.connection)
+        last_id = chunk[-1][0]
+
+
+def drop_message_index(apps, schema_editor):
+    if message_index.is_available(schema_editor.connection):
+        message_index.drop(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0004_message_unread_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_message_index, drop_message_index),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from collections import Counter
+
+
+def backfill_unread_counters(apps, schema_editor):
+    Message = apps.get_model('message_control', 'Message')
+    ReadCursor = apps.get_model('message_control', 'ReadCursor')
+    UnreadCounter = apps.get_model('message_control', 'UnreadCounter')
+    UnreadTotal = apps.get_model('message_control', 'UnreadTotal')
+
+    read = ReadCursor.objects.filter(
+        user_id=models.OuterRef('receiver_id'), peer_id=models.OuterRef('sender_id'),
+        last_read_at__gte=models.OuterRef('created_at'))
+    rows = Message.objects.filter(is_read=False).filter(~models.Exists(read)).order_by(
+    ).values('receiver_id', 'sender_id').annotate(count=models.Count('id'))
+
+    totals = Counter()
+    counters = []
+    for row in rows.iterator():
+        counters.append(UnreadCounter(**row))
+        totals[row['receiver_id']] += row['count']
+    UnreadCounter.objects.bulk_create(counters, batch_size=1000)
+    UnreadTotal.objects.bulk_create([
+        UnreadTotal(user_id=user_id, count=count) for user_id, count in totals.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_control', '0004_revokedtoken'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('message_control', '0006_readcursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadTotal',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_total', serialize=False, to='user_control.customuser')),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcounter',
+            constraint=models.UniqueConstraint(fields=('receiver', 'sender'), name='unread_counter_receiver_sender'),
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
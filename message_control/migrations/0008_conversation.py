@@ -0,0 +1,72 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_conversations(apps, schema_editor):
+    Message = apps.get_model('message_control', 'Message')
+    Conversation = apps.get_model('message_control', 'Conversation')
+    UnreadCounter = apps.get_model('message_control', 'UnreadCounter')
+
+    unread = {(receiver_id, sender_id): count for receiver_id, sender_id, count
+              in UnreadCounter.objects.values_list('receiver_id', 'sender_id', 'count')}
+    newest = Message.objects.filter(
+        conversation_key=models.OuterRef('conversation_key')
+    ).order_by('-created_at', '-id').values('id')[:1]
+    latest = Message.objects.annotate(newest_id=models.Subquery(newest)).filter(
+        id=models.F('newest_id')).order_by('id')
+
+    last_id = 0
+    while True:
+        chunk = list(latest.filter(id__gt=last_id)[:BACKFILL_CHUNK_SIZE])
+        if not chunk:
+            break
+        conversations = []
+        for message in chunk:
+            low, high = sorted((message.sender_id, message.receiver_id))
+            conversations.append(Conversation(
+                key=message.conversation_key, user_low_id=low, user_high_id=high,
+                last_message_id=message.id, preview=(message.message or '')[:100],
+                last_message_at=message.created_at,
+                low_unread_count=unread.get((low, high), 0),
+                high_unread_count=unread.get((high, low), 0) if low != high else 0))
+        Conversation.objects.bulk_create(conversations)
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('message_control', '0007_unread_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True)),
+                ('preview', models.CharField(blank=True, default='', max_length=100)),
+                ('last_message_at', models.DateTimeField(null=True)),
+                ('low_unread_count', models.IntegerField(default=0)),
+                ('high_unread_count', models.IntegerField(default=0)),
+                ('last_message', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='message_control.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_low', '-last_message_at'], name='conversation_low_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_high', '-last_message_at'], name='conversation_high_inbox_idx'),
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
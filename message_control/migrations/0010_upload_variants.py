@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0009_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genericfileupload',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:19
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_references(apps, schema_editor):
+    GenericFileUpload = apps.get_model('message_control', 'GenericFileUpload')
+    MessageAttachment = apps.get_model('message_control', 'MessageAttachment')
+    UserProfile = apps.get_model('user_control', 'UserProfile')
+
+    def count(model, field):
+        return Coalesce(models.Subquery(
+            model.objects.filter(**{field: models.OuterRef('pk')}).order_by().values(
+                field).annotate(count=models.Count('pk')).values('count'),
+            output_field=models.IntegerField()), 0)
+
+    GenericFileUpload.objects.update(ref_count=count(
+        MessageAttachment, 'attachment') + count(UserProfile, 'profile_picture'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0010_upload_variants'),
+        ('user_control', '0004_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genericfileupload',
+            name='digest',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='genericfileupload',
+            name='ref_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0011_upload_digest'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'updated_at'], name='message_sender_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'updated_at'], name='message_receiver_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readcursor',
+            index=models.Index(fields=['user', 'updated_at'], name='read_cursor_user_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readcursor',
+            index=models.Index(fields=['peer', 'updated_at'], name='read_cursor_peer_sync_idx'),
+        ),
+    ]
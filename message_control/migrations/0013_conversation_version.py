@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message_control', '0012_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,13 +1,121 @@
-from django.db import models
+import uuid
+from django.db import models, transaction, IntegrityError
+from django.db.models.functions import Coalesce, Greatest
+from collections import Counter
+from django.utils import timezone
+from .media_urls import media_url_cache
 
 
 class GenericFileUpload(models.Model):
     file_upload = models.FileField()
+    # storage names of the scaled down copies of images, per variant
+    variants = models.JSONField(default=dict, blank=True, editable=False)
+    # sha256 of the content, the same content is only ever stored once
+    digest = models.CharField(max_length=64, unique=True, null=True, editable=False)
+    # message attachments and profile pictures using this upload
+    ref_count = models.IntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.file_upload}"
 
+    @classmethod
+    def add_references(cls, upload_ids, delta=1):
+        for upload_id, count in Counter(upload_ids).items():
+            cls.objects.filter(id=upload_id).update(
+                ref_count=models.F("ref_count") + count * delta)
+
+    @classmethod
+    def release(cls, upload_ids):
+        # drop references and delete whatever nobody uses any more, the
+        # stored files go once the transaction has committed
+        upload_ids = [upload_id for upload_id in upload_ids if upload_id]
+        if not upload_ids:
+            return
+        with transaction.atomic():
+            cls.add_references(upload_ids, -1)
+            for upload in cls.objects.select_for_update().filter(
+                    id__in=set(upload_ids), ref_count__lte=0):
+                upload.delete()
+                transaction.on_commit(upload.delete_files)
+
+    @classmethod
+    def bump_referrers(cls, upload_ids):
+        # the URLs of these uploads changed, so did the payloads showing them
+        from user_control.models import UserProfile
+
+        UserProfile.bump(UserProfile.objects.filter(
+            profile_picture_id__in=upload_ids).values("user_id"))
+        Conversation.bump(Message.objects.filter(
+            message_attachments__attachment_id__in=upload_ids).values("conversation_key"))
+
+    def delete_files(self):
+        storage = self.file_upload.storage
+        names = [name for name in [self.file_upload.name, *self.variants.values()] if name]
+        for name in names:
+            storage.delete(name)
+        media_url_cache.discard(names)
+
+
+# a file arriving in chunks over several requests, see uploads.py
+class ChunkedUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        "user_control.CustomUser", related_name="chunked_uploads", on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    # storage name and multipart state when chunks go straight to S3
+    name = models.CharField(max_length=255, blank=True, default="")
+    upload_id = models.CharField(max_length=255, blank=True, default="")
+    parts = models.JSONField(default=list)
+    file_upload = models.ForeignKey(
+        GenericFileUpload, related_name="+", null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def unread(self, receiver_id, sender_ids=None):
+        # not flagged as read and newer than the receiver's read cursor for
+        # the sender, the rule the unread counters were backfilled with
+        queryset = self.filter(receiver_id=receiver_id, is_read=False)
+        if sender_ids is not None and len(sender_ids) == 1:
+            # one conversation: its cursor is read once and the count is a
+            # range on message_unread_idx
+            sender_id, = sender_ids
+            read_until = ReadCursor.objects.filter(
+                user_id=receiver_id, peer_id=sender_id
+            ).values_list("last_read_at", flat=True).first()
+            queryset = queryset.filter(sender_id=sender_id)
+            if read_until is None:
+                return queryset
+            return queryset.filter(created_at__gt=read_until)
+
+        if sender_ids is not None:
+            queryset = queryset.filter(sender_id__in=sender_ids)
+        # any number of conversations: every message is compared with its
+        # sender's cursor, looked up by (user, peer)
+        read_until = ReadCursor.objects.filter(
+            user_id=receiver_id, peer_id=models.OuterRef("sender_id")
+        ).values("last_read_at")[:1]
+        return queryset.annotate(read_until=models.Subquery(read_until)).filter(
+            models.Q(read_until__isnull=True) |
+            models.Q(created_at__gt=models.F("read_until")))
+
+    def unread_counts(self, receiver_id, sender_ids=None):
+        # unread messages sent to receiver_id, grouped per sender; every
+        # sender without sender_ids
+        if not receiver_id or sender_ids is not None and not sender_ids:
+            return {}
+        rows = self.unread(receiver_id, sender_ids).order_by().values(
+            "sender_id").annotate(count=models.Count("id"))
+        return {row["sender_id"]: row["count"] for row in rows}
+
 
 class Message(models.Model):
     sender = models.ForeignKey(
@@ -16,14 +124,364 @@ class Message(models.Model):
         "user_control.CustomUser", related_name="message_receiver", on_delete=models.CASCADE)
     message = models.TextField(blank=True, null=True)
     is_read = models.BooleanField(default=False)
+    conversation_key = models.CharField(
+        max_length=50, default="", editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = MessageQuerySet.as_manager()
+
     def __str__(self):
         return f"message between {self.sender.username} and {self.receiver.username}"
 
+    @staticmethod
+    def get_conversation_key(user_id, other_user_id):
+        low, high = sorted((int(user_id), int(other_user_id)))
+        return f"{low}:{high}"
+
+    def save(self, *args, **kwargs):
+        self.conversation_key = self.get_conversation_key(
+            self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ("-created_at",)
+        indexes = [
+            models.Index(fields=["conversation_key", "-created_at"],
+                         name="message_conversation_idx"),
+            # unread badges count the range past the receiver's read cursor
+            models.Index(fields=["receiver", "sender", "created_at"],
+                         name="message_unread_idx"),
+            # sync reads both sides of a user's messages past a watermark
+            models.Index(fields=["sender", "updated_at"],
+                         name="message_sender_sync_idx"),
+            models.Index(fields=["receiver", "updated_at"],
+                         name="message_receiver_sync_idx"),
+        ]
+
+
+# everything user received from peer up to last_read_at has been read
+class ReadCursor(models.Model):
+    user = models.ForeignKey(
+        "user_control.CustomUser", related_name="read_cursors", on_delete=models.CASCADE)
+    peer = models.ForeignKey(
+        "user_control.CustomUser", related_name="+", on_delete=models.CASCADE)
+    last_read_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "peer"], name="read_cursor_user_peer"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "updated_at"],
+                         name="read_cursor_user_sync_idx"),
+            models.Index(fields=["peer", "updated_at"],
+                         name="read_cursor_peer_sync_idx"),
+        ]
+
+    @classmethod
+    def advance(cls, user_id, peer_id, read_at):
+        # upsert that never moves a cursor backwards
+        Conversation.bump([Message.get_conversation_key(user_id, peer_id)])
+        cursors = cls.objects.filter(user_id=user_id, peer_id=peer_id)
+        if cursors.update(last_read_at=Greatest("last_read_at", models.Value(read_at)),
+                          updated_at=timezone.now()):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    user_id=user_id, peer_id=peer_id, last_read_at=read_at)
+        except IntegrityError:
+            cursors.update(last_read_at=Greatest("last_read_at", models.Value(read_at)),
+                           updated_at=timezone.now())
+
+
+# rows written per statement by the bulk paths below
+BULK_BATCH_SIZE = 200
+
+
+def add_count(queryset, delta, **defaults):
+    # increments the single row matched by queryset, creating it when missing
+    if queryset.update(count=models.F("count") + delta) or delta < 0:
+        return
+    try:
+        with transaction.atomic():
+            queryset.model.objects.create(count=delta, **defaults)
+    except IntegrityError:
+        queryset.update(count=models.F("count") + delta)
+
+
+def per_row(fields, values, output_field):
+    # CASE picking the value of each row by its fields, values are keyed by
+    # tuples of those fields' values
+    return models.Case(*[
+        models.When(models.Q(**dict(zip(fields, key))),
+                    then=models.Value(value, output_field=output_field))
+        for key, value in values.items()
+    ], output_field=output_field)
+
+
+def add_counts(model, fields, deltas):
+    # add_count for many rows: the missing ones are inserted empty, then a
+    # single UPDATE per batch adds every delta
+    deltas = sorted((key, delta) for key, delta in deltas.items() if delta)
+    for start in range(0, len(deltas), BULK_BATCH_SIZE):
+        batch = dict(deltas[start:start + BULK_BATCH_SIZE])
+        model.objects.bulk_create([
+            model(**dict(zip(fields, key))) for key in batch], ignore_conflicts=True)
+        model.objects.filter(**{
+            f"{field}__in": {key[i] for key in batch} for i, field in enumerate(fields)
+        }).update(count=models.F("count") + models.Case(
+            *[models.When(models.Q(**dict(zip(fields, key))), then=models.Value(delta))
+              for key, delta in batch.items()],
+            default=models.Value(0), output_field=models.IntegerField()))
+
+
+# unread messages receiver has from sender, kept up to date as messages are
+# written and read so badges never count Message rows
+class UnreadCounter(models.Model):
+    receiver = models.ForeignKey(
+        "user_control.CustomUser", related_name="unread_counters", on_delete=models.CASCADE)
+    sender = models.ForeignKey(
+        "user_control.CustomUser", related_name="+", on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["receiver", "sender"], name="unread_counter_receiver_sender"),
+        ]
+
+    @classmethod
+    def increment(cls, messages):
+        # messages are (receiver_id, sender_id) pairs, one per new message
+        pairs = Counter(messages)
+        totals = Counter()
+        for (receiver_id, sender_id), count in pairs.items():
+            totals[receiver_id] += count
+
+        with transaction.atomic():
+            add_counts(cls, ("receiver_id", "sender_id"), pairs)
+            Conversation.add_unread_many(pairs)
+            add_counts(UnreadTotal, ("user_id", ), {
+                (receiver_id, ): count for receiver_id, count in totals.items()})
+
+    @classmethod
+    def refresh(cls, receiver_id, sender_id):
+        # recount one conversation after messages in it were read, edited or
+        # deleted and move the receiver's total by the difference
+        counters = cls.objects.filter(receiver_id=receiver_id, sender_id=sender_id)
+        with transaction.atomic():
+            counter = counters.select_for_update().first()
+            count = Message.objects.unread(receiver_id, [sender_id]).count()
+            previous = counter.count if counter is not None else 0
+            if count == previous:
+                return
+            add_count(counters, count - previous,
+                      receiver_id=receiver_id, sender_id=sender_id)
+            UnreadTotal.add(receiver_id, count - previous)
+            Conversation.add_unread(receiver_id, sender_id, count - previous)
+
+    @classmethod
+    def reconcile(cls, receiver_ids):
+        # recompute every counter and total of receiver_ids from the
+        # messages, returns how many counters were off
+        with transaction.atomic():
+            counts = {(receiver_id, sender_id): count
+                      for receiver_id in set(receiver_ids)
+                      for sender_id, count in Message.objects.unread_counts(receiver_id).items()}
+
+            counters = cls.objects.filter(receiver_id__in=receiver_ids)
+            previous = {(receiver_id, sender_id): count for receiver_id, sender_id, count
+                        in counters.values_list("receiver_id", "sender_id", "count")}
+            counters.delete()
+            cls.objects.bulk_create([
+                cls(receiver_id=receiver_id, sender_id=sender_id, count=count)
+                for (receiver_id, sender_id), count in counts.items()])
+
+            totals = Counter()
+            for (receiver_id, sender_id), count in counts.items():
+                totals[receiver_id] += count
+            UnreadTotal.objects.filter(user_id__in=receiver_ids).delete()
+            UnreadTotal.objects.bulk_create([
+                UnreadTotal(user_id=user_id, count=count)
+                for user_id, count in totals.items()])
+
+            for side, peer in (("low", "high"), ("high", "low")):
+                counter = cls.objects.filter(
+                    receiver_id=models.OuterRef(f"user_{side}_id"),
+                    sender_id=models.OuterRef(f"user_{peer}_id")).values("count")[:1]
+                Conversation.objects.filter(**{f"user_{side}_id__in": receiver_ids}).update(**{
+                    f"{side}_unread_count": Coalesce(models.Subquery(
+                        counter, output_field=models.IntegerField()), 0)})
+
+        return sum(1 for pair in counts.keys() | previous.keys()
+                   if counts.get(pair, 0) != previous.get(pair, 0))
+
+    @classmethod
+    def counts(cls, receiver_id, sender_ids):
+        if not receiver_id or not sender_ids:
+            return {}
+        return dict(cls.objects.filter(
+            receiver_id=receiver_id, sender_id__in=sender_ids, count__gt=0
+        ).values_list("sender_id", "count"))
+
+    @classmethod
+    def count_subquery(cls, receiver_id, sender_ref):
+        counts = cls.objects.filter(
+            receiver_id=receiver_id, sender_id=sender_ref).values("count")[:1]
+        return Coalesce(
+            models.Subquery(counts, output_field=models.IntegerField()), 0)
+
+
+# everything a user has unread, for the global badge
+class UnreadTotal(models.Model):
+    user = models.OneToOneField(
+        "user_control.CustomUser", primary_key=True, related_name="unread_total",
+        on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def add(cls, user_id, delta):
+        if delta:
+            add_count(cls.objects.filter(user_id=user_id), delta, user_id=user_id)
+
+    @classmethod
+    def get(cls, user_id):
+        return cls.objects.filter(pk=user_id).values_list(
+            "count", flat=True).first() or 0
+
+
+# one row per pair of users with the latest message between them, for the
+# inbox; user_low is the lower of the two user ids
+class Conversation(models.Model):
+    key = models.CharField(max_length=50, unique=True)
+    user_low = models.ForeignKey(
+        "user_control.CustomUser", related_name="+", on_delete=models.CASCADE)
+    user_high = models.ForeignKey(
+        "user_control.CustomUser", related_name="+", on_delete=models.CASCADE)
+    last_message = models.ForeignKey(
+        Message, related_name="+", null=True, on_delete=models.SET_NULL)
+    preview = models.CharField(max_length=100, blank=True, default="")
+    last_message_at = models.DateTimeField(null=True)
+    low_unread_count = models.IntegerField(default=0)
+    high_unread_count = models.IntegerField(default=0)
+    # bumped by every change to the messages or read cursors of the
+    # conversation, the thread's ETag is derived from it
+    version = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_low", "-last_message_at"],
+                         name="conversation_low_inbox_idx"),
+            models.Index(fields=["user_high", "-last_message_at"],
+                         name="conversation_high_inbox_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # moved in the database only, an instance never writes back a
+        # version it read earlier
+        if self.pk is not None:
+            self.version = models.F("version") + 1
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def get_preview(cls, text):
+        return (text or "")[:cls._meta.get_field("preview").max_length]
+
+    @classmethod
+    def record(cls, messages):
+        # point each conversation at the newest of messages, unless it
+        # already shows something newer
+        latest = {}
+        for message in messages:
+            key = Message.get_conversation_key(message.sender_id, message.receiver_id)
+            current = latest.get(key)
+            if current is None or (message.created_at, message.id) > (current.created_at, current.id):
+                latest[key] = message
+
+        latest = sorted(latest.items())
+        with transaction.atomic():
+            for start in range(0, len(latest), BULK_BATCH_SIZE):
+                cls.record_batch(dict(latest[start:start + BULK_BATCH_SIZE]))
+
+    @classmethod
+    def record_batch(cls, latest):
+        # missing conversations are inserted empty and filled in with the
+        # others, by one UPDATE that leaves alone what shows something newer
+        cls.objects.bulk_create([
+            cls(key=key, user_low_id=min(message.sender_id, message.receiver_id),
+                user_high_id=max(message.sender_id, message.receiver_id))
+            for key, message in latest.items()], ignore_conflicts=True)
+
+        def take(field, values, output_field):
+            return models.Case(models.When(
+                older, then=per_row(("key", ), values, output_field)
+            ), default=models.F(field), output_field=output_field)
+
+        created_at = per_row(("key", ), {
+            (key, ): message.created_at for key, message in latest.items()
+        }, models.DateTimeField())
+        older = models.Q(last_message_at__isnull=True) | \
+            models.Q(last_message_at__lte=created_at)
+        # the thread changed either way
+        cls.objects.filter(key__in=latest).update(
+            last_message_id=take("last_message_id", {
+                (key, ): message.id for key, message in latest.items()
+            }, models.IntegerField()),
+            preview=take("preview", {
+                (key, ): cls.get_preview(message.message) for key, message in latest.items()
+            }, models.CharField()),
+            last_message_at=take("last_message_at", {
+                (key, ): message.created_at for key, message in latest.items()
+            }, models.DateTimeField()),
+            version=models.F("version") + 1)
+
+    @classmethod
+    def refresh(cls, key):
+        # after the last message was edited or deleted
+        message = Message.objects.filter(conversation_key=key).order_by(
+            "-created_at", "-id").first()
+        if message is None:
+            cls.objects.filter(key=key).delete()
+            return
+        cls.objects.filter(key=key).update(
+            last_message_id=message.id,
+            preview=cls.get_preview(message.message),
+            last_message_at=message.created_at,
+            version=models.F("version") + 1)
+
+    @classmethod
+    def bump(cls, keys):
+        cls.objects.filter(key__in=keys).update(version=models.F("version") + 1)
+
+    @classmethod
+    def add_unread(cls, receiver_id, sender_id, delta):
+        cls.add_unread_many({(receiver_id, sender_id): delta})
+
+    @classmethod
+    def add_unread_many(cls, deltas):
+        # deltas are keyed by (receiver_id, sender_id), one UPDATE per batch
+        deltas = sorted((pair, delta) for pair, delta in deltas.items() if delta)
+        for start in range(0, len(deltas), BULK_BATCH_SIZE):
+            sides = {"low_unread_count": {}, "high_unread_count": {}}
+            for (receiver_id, sender_id), delta in deltas[start:start + BULK_BATCH_SIZE]:
+                field = "low_unread_count" if int(receiver_id) <= int(sender_id) else "high_unread_count"
+                key = Message.get_conversation_key(receiver_id, sender_id)
+                sides[field][key] = sides[field].get(key, 0) + delta
+            cls.objects.filter(key__in={key for side in sides.values() for key in side}).update(**{
+                field: models.F(field) + models.Case(
+                    *[models.When(key=key, then=models.Value(delta)) for key, delta in side.items()],
+                    default=models.Value(0), output_field=models.IntegerField())
+                for field, side in sides.items() if side})
+
+    def get_peer(self, user_id):
+        return self.user_high if self.user_low_id == user_id else self.user_low
+
+    def get_unread_count(self, user_id):
+        return self.low_unread_count if self.user_low_id == user_id else self.high_unread_count
 
 
 class MessageAttachment(models.Model):
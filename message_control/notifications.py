@@ -0,0 +1,122 @@
+import json
+import queue
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+
+# hands notifications to the socket server from background threads so the
+# request that created a message never waits on it
+class NotificationDispatcher:
+
+    def __init__(self, url=None, workers=None, queue_size=None, batch_size=None,
+                 max_retries=None, timeout=None, backoff=None):
+        self.url = url
+        self.workers = workers if workers is not None else getattr(
+            settings, "SOCKET_DISPATCH_WORKERS", 2)
+        self.batch_size = batch_size or getattr(
+            settings, "SOCKET_BATCH_SIZE", 50)
+        self.max_retries = max_retries if max_retries is not None else getattr(
+            settings, "SOCKET_MAX_RETRIES", 3)
+        self.timeout = timeout or getattr(settings, "SOCKET_TIMEOUT", 2)
+        self.backoff = backoff if backoff is not None else getattr(
+            settings, "SOCKET_RETRY_BACKOFF", 0.5)
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size or getattr(
+            settings, "SOCKET_QUEUE_SIZE", 1000))
+        self._threads = []
+        self._lock = threading.Lock()
+
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max(self.workers, 1))
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json"
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_url(self):
+        return self.url or settings.SOCKET_SERVER
+
+    def submit(self, notification):
+        return self.submit_many([notification]) == 1
+
+    def submit_many(self, notifications):
+        # one queue entry and one payload per request, however many
+        # receivers it has
+        notifications = list(notifications)
+        if not notifications:
+            return 0
+        self.start()
+        try:
+            self._queue.put_nowait(notifications)
+        except queue.Full:
+            # shed load rather than block the request
+            with self._lock:
+                self.dropped += len(notifications)
+            return 0
+        return len(notifications)
+
+    def start(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name="socket-dispatcher", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def next_batch(self, block=True):
+        # whole requests are joined up to batch_size, never split
+        try:
+            batch = list(self._queue.get(block=block))
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.extend(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def send(self, batch):
+        # a single notification keeps the original payload shape
+        payload = batch[0] if len(batch) == 1 else batch
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(
+                    self.get_url(), json.dumps(payload), timeout=self.timeout)
+                if response.status_code < 500:
+                    return True
+            except Exception:
+                pass
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "sent": self.sent,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+    def _run(self):
+        while True:
+            batch = self.next_batch()
+            delivered = self.send(batch)
+            with self._lock:
+                if delivered:
+                    self.sent += len(batch)
+                else:
+                    self.failed += len(batch)
+
+
+notification_dispatcher = NotificationDispatcher()
@@ -0,0 +1,35 @@
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
+
+
+class MessageCursorPagination(CursorPagination):
+    # keyset on (created_at, id): every page is an index seek, however deep
+    ordering = ("-created_at", "-id")
+
+
+class ConversationPagination(CursorPagination):
+    ordering = ("-last_message_at", "-id")
+
+
+class MessagePagination(BasePagination):
+    # page numbers by default; clients opt into cursors by sending ?cursor=
+    # (empty for the first page) and following the next/previous links
+
+    def get_paginator(self, request):
+        if MessageCursorPagination.cursor_query_param in request.query_params:
+            return MessageCursorPagination()
+        return PageNumberPagination()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self.get_paginator(request)
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    @property
+    def display_page_controls(self):
+        paginator = getattr(self, "paginator", None)
+        return bool(paginator and paginator.display_page_controls)
+
+    def to_html(self):
+        return self.paginator.to_html()
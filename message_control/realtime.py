@@ -0,0 +1,155 @@
+import asyncio
+import json
+import threading
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+# in-process stand-in for a pub/sub broker (e.g. redis) with the interface
+# SubscriptionRegistry expects; it never reaches another process, so it only
+# suits a deployment running a single one. several processes point
+# REALTIME_BROKER at a shared implementation of the same interface
+class LocalBroker:
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def publish(self, user_id, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(user_id, payload)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+
+# open websocket connections of this process, per user id
+class SubscriptionRegistry:
+
+    def __init__(self, broker=None, queue_size=None):
+        self.queue_size = queue_size or getattr(
+            settings, "REALTIME_QUEUE_SIZE", 100)
+        self.dropped = 0
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._broker = broker
+        if broker is not None:
+            broker.subscribe(self.deliver)
+
+    def subscribe(self, user_id):
+        subscription = (asyncio.get_event_loop(),
+                        asyncio.Queue(self.queue_size))
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(user_id)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[user_id]
+
+    def publish(self, user_id, payload):
+        # True when the payload reached every process that may hold a
+        # connection of the user: always through a shared broker, without
+        # one only if the user is connected here
+        if self._broker is not None:
+            self._broker.publish(user_id, payload)
+            return True
+        return self.deliver(user_id, payload) > 0
+
+    def deliver(self, user_id, payload):
+        # safe to call from any thread, the payload is handed to each
+        # connection's own event loop
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for loop, queue in subscriptions:
+            loop.call_soon_threadsafe(self._put, queue, payload)
+        return len(subscriptions)
+
+    def is_connected(self, user_id):
+        with self._lock:
+            return user_id in self._subscriptions
+
+    def _put(self, queue, payload):
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+
+def get_broker():
+    broker = getattr(settings, "REALTIME_BROKER", None)
+    if broker:
+        return import_string(broker)()
+    # without a broker only the websockets of this process are reached, the
+    # external socket server carries notifications to users connected elsewhere
+    if not getattr(settings, "SOCKET_SERVER", ""):
+        raise ImproperlyConfigured(
+            "Set SOCKET_SERVER, or REALTIME_BROKER to a broker shared by all processes.")
+    return None
+
+
+subscriptions = SubscriptionRegistry(broker=get_broker())
+
+
+def get_token(scope):
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("token"):
+        return query["token"][0]
+
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            return value.decode()[7:]
+    return None
+
+
+async def websocket_application(scope, receive, send):
+    from user_control.authentication import Authentication
+
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+
+    token = get_token(scope)
+    # verification may consult the revocation list in the database
+    data = await sync_to_async(Authentication.verify_token)(token) if token else None
+    if not data:
+        await send({"type": "websocket.close", "code": 4001})
+        return
+
+    user_id = data["user_id"]
+    await send({"type": "websocket.accept"})
+    subscription = subscriptions.subscribe(user_id)
+    queue = subscription[1]
+
+    receiving = asyncio.ensure_future(receive())
+    outgoing = asyncio.ensure_future(queue.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                (receiving, outgoing), return_when=asyncio.FIRST_COMPLETED)
+
+            if outgoing in done:
+                await send({"type": "websocket.send",
+                            "text": json.dumps(outgoing.result())})
+                outgoing = asyncio.ensure_future(queue.get())
+
+            if receiving in done:
+                if receiving.result()["type"] == "websocket.disconnect":
+                    break
+                # clients only listen, anything they send is ignored
+                receiving = asyncio.ensure_future(receive())
+    finally:
+        subscriptions.unsubscribe(user_id, subscription)
+        receiving.cancel()
+        outgoing.cancel()
@@ -0,0 +1,40 @@
+from chatapi.fts import FullTextIndex
+from .models import Message
+
+message_index = FullTextIndex(
+    "message_control_message_search", ("message", ),
+    tokenize="unicode61 remove_diacritics 2")
+
+
+def index_messages(messages):
+    if not message_index.is_available():
+        return
+    messages = list(messages)
+    message_index.upsert_many(
+        (message.id, {"message": message.message})
+        for message in messages if message.message)
+    # an edit may have cleared the text
+    message_index.delete_many(
+        message.id for message in messages if not message.message)
+
+
+def unindex_message(message_id):
+    if message_index.is_available():
+        message_index.delete(message_id)
+
+
+def iter_message_chunks(chunk_size):
+    # short reads by primary key range, never a long lock on the table
+    last_id = 0
+    while True:
+        chunk = list(Message.objects.filter(id__gt=last_id).order_by(
+            "id").values_list("id", "message")[:chunk_size])
+        if not chunk:
+            return
+        yield [(message_id, {"message": text})
+               for message_id, text in chunk if text]
+        last_id = chunk[-1][0]
+
+
+def rebuild_message_index(chunk_size=1000):
+    return message_index.rebuild(iter_message_chunks(chunk_size))
@@ -1,12 +1,63 @@
+import os
+from django.conf import settings
 from rest_framework import serializers
-from .models import GenericFileUpload, Message, MessageAttachment
+from .media_urls import get_urls, prefetch_urls
+from .models import ChunkedUpload, Conversation, GenericFileUpload, Message, MessageAttachment, ReadCursor, UnreadCounter
+
+
+class MediaUrlField(serializers.FileField):
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = get_urls(value.instance)["file_upload"]
+        request = self.context.get("request", None)
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class GenericFileUploadListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        uploads = list(data.all() if hasattr(data, "all") else data)
+        prefetch_urls(uploads)
+        return super().to_representation(uploads)
 
 
 class GenericFileUploadSerializer(serializers.ModelSerializer):
+    file_upload = MediaUrlField()
+    variants = serializers.SerializerMethodField("get_variants")
 
     class Meta:
         model = GenericFileUpload
         fields = "__all__"
+        list_serializer_class = GenericFileUploadListSerializer
+
+    def get_variants(self, obj):
+        return get_urls(obj)["variants"]
+
+
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    file_upload = GenericFileUploadSerializer(read_only=True)
+
+    class Meta:
+        model = ChunkedUpload
+        fields = ("id", "filename", "size", "offset", "file_upload", "created_at")
+        read_only_fields = ("offset", )
+
+    def validate_filename(self, value):
+        name = os.path.basename(value)
+        if not name:
+            raise serializers.ValidationError("Invalid file name.")
+        return name
+
+    def validate_size(self, value):
+        max_size = getattr(settings, "CHUNKED_UPLOAD_MAX_SIZE", 2 * 1024 ** 3)
+        if value < 1 or value > max_size:
+            raise serializers.ValidationError(
+                f"Size must be between 1 and {max_size} bytes.")
+        return value
 
 
 class MessageAttachmentSerializer(serializers.ModelSerializer):
@@ -17,6 +68,57 @@ class MessageAttachmentSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+def attach_read_until(messages):
+    read_until = {}
+    if messages:
+        cursors = ReadCursor.objects.filter(
+            user_id__in={message.receiver_id for message in messages},
+            peer_id__in={message.sender_id for message in messages})
+        read_until = {(cursor.user_id, cursor.peer_id): cursor.last_read_at
+                      for cursor in cursors}
+    for message in messages:
+        message.read_until = read_until.get(
+            (message.receiver_id, message.sender_id))
+
+
+class MessageListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        messages = list(data.all() if hasattr(data, "all") else data)
+
+        # one counter lookup for every profile on the page instead of one
+        # per embedded sender/receiver
+        try:
+            viewer_id = self.context["request"].user.id
+        except Exception:
+            viewer_id = None
+
+        profiles = []
+        for message in messages:
+            for user in (message.sender, message.receiver):
+                try:
+                    profiles.append(user.user_profile)
+                except Exception:
+                    pass
+
+        counts = UnreadCounter.counts(
+            viewer_id, {profile.user_id for profile in profiles})
+        for profile in profiles:
+            profile.unread_count = counts.get(profile.user_id, 0)
+
+        # and one lookup of the read cursors behind every is_read flag
+        attach_read_until(messages)
+
+        # and one pass over the URLs of every picture and attachment
+        uploads = [profile.profile_picture for profile in profiles]
+        for message in messages:
+            uploads.extend(attachment.attachment
+                           for attachment in message.message_attachments.all())
+        prefetch_urls(uploads)
+
+        return super().to_representation(messages)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender = serializers.SerializerMethodField("get_sender_data")
     sender_id = serializers.IntegerField(write_only=True)
@@ -27,12 +129,119 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = "__all__"
+        exclude = ("conversation_key", )
+        list_serializer_class = MessageListSerializer
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # messages below the receiver's read cursor count as read
+        data["is_read"] = instance.is_read or self.is_below_cursor(instance)
+        return data
+
+    @staticmethod
+    def is_below_cursor(obj):
+        if hasattr(obj, "read_until"):
+            read_until = obj.read_until
+        else:
+            read_until = ReadCursor.objects.filter(
+                user_id=obj.receiver_id, peer_id=obj.sender_id
+            ).values_list("last_read_at", flat=True).first()
+        return read_until is not None and obj.created_at <= read_until
 
     def get_receiver_data(self, obj):
         from user_control.serializers import UserProfileSerializer
-        return UserProfileSerializer(obj.receiver.user_profile).data
+        return UserProfileSerializer(
+            obj.receiver.user_profile, context=self.context).data
 
     def get_sender_data(self, obj):
         from user_control.serializers import UserProfileSerializer
-        return UserProfileSerializer(obj.sender.user_profile).data
+        return UserProfileSerializer(
+            obj.sender.user_profile, context=self.context).data
+
+
+class MessageSyncListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        messages = list(data.all() if hasattr(data, "all") else data)
+        attach_read_until(messages)
+        prefetch_urls([attachment.attachment for message in messages
+                       for attachment in message.message_attachments.all()])
+        return super().to_representation(messages)
+
+
+class MessageSyncSerializer(serializers.ModelSerializer):
+    # no embedded profiles, a syncing client already has them
+    message_attachments = MessageAttachmentSerializer(
+        read_only=True, many=True)
+
+    class Meta:
+        model = Message
+        fields = ("id", "sender_id", "receiver_id", "message", "is_read",
+                  "message_attachments", "created_at", "updated_at")
+        list_serializer_class = MessageSyncListSerializer
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data["is_read"] = instance.is_read or MessageSerializer.is_below_cursor(instance)
+        return data
+
+
+class MessageSearchSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        pass
+
+
+class ConversationListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        conversations = list(data.all() if hasattr(data, "all") else data)
+        try:
+            user_id = self.context["request"].user.id
+        except Exception:
+            user_id = None
+
+        uploads = []
+        for conversation in conversations:
+            try:
+                uploads.append(conversation.get_peer(user_id).user_profile.profile_picture)
+            except Exception:
+                pass
+        prefetch_urls(uploads)
+        return super().to_representation(conversations)
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+    peer = serializers.SerializerMethodField("get_peer_data")
+    unread_count = serializers.SerializerMethodField("get_unread_count")
+
+    class Meta:
+        model = Conversation
+        fields = ("id", "peer", "last_message", "preview",
+                  "last_message_at", "unread_count")
+        list_serializer_class = ConversationListSerializer
+
+    def get_user_id(self):
+        return self.context["request"].user.id
+
+    def get_peer_data(self, obj):
+        # kept flat so a page needs nothing beyond its own query
+        peer = obj.get_peer(self.get_user_id())
+        try:
+            profile = peer.user_profile
+        except Exception:
+            profile = None
+        return {
+            "id": peer.id,
+            "username": peer.username,
+            "is_online": peer.is_online,
+            "first_name": profile.first_name if profile else None,
+            "last_name": profile.last_name if profile else None,
+            "profile_picture": GenericFileUploadSerializer(
+                profile.profile_picture).data if profile and profile.profile_picture else None,
+        }
+
+    def get_unread_count(self, obj):
+        return obj.get_unread_count(self.get_user_id())
@@ -0,0 +1,69 @@
+from django.db.models import Case, F, Value, When
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Conversation, GenericFileUpload, Message, MessageAttachment, UnreadCounter
+from .search import index_messages, unindex_message
+from .thumbnails import is_image, thumbnail_generator
+
+
+@receiver(post_save, sender=GenericFileUpload)
+def generate_thumbnails(sender, instance, created, **kwargs):
+    if created and is_image(instance.file_upload.name):
+        thumbnail_generator.submit(instance.id)
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    index_messages([instance])
+
+
+@receiver(post_delete, sender=Message)
+def unindex_deleted_message(sender, instance, **kwargs):
+    unindex_message(instance.id)
+
+
+# ahead of the unread counters, which also update the conversation row
+@receiver(post_save, sender=Message)
+def record_conversation(sender, instance, created, **kwargs):
+    if created:
+        Conversation.record([instance])
+    else:
+        Conversation.objects.filter(key=instance.conversation_key).update(
+            preview=Case(When(last_message_id=instance.id,
+                              then=Value(Conversation.get_preview(instance.message))),
+                         default=F("preview")),
+            version=F("version") + 1)
+
+
+@receiver(post_delete, sender=Message)
+def refresh_conversation(sender, instance, **kwargs):
+    # only when the conversation was showing this message, otherwise it
+    # just gets a new version
+    if not Conversation.objects.filter(
+            key=instance.conversation_key, last_message_at__gt=instance.created_at
+    ).update(version=F("version") + 1):
+        Conversation.refresh(instance.conversation_key)
+
+
+@receiver(post_save, sender=Message)
+def count_unread_message(sender, instance, created, **kwargs):
+    if not created:
+        UnreadCounter.refresh(instance.receiver_id, instance.sender_id)
+    elif not instance.is_read:
+        UnreadCounter.increment([(instance.receiver_id, instance.sender_id)])
+
+
+@receiver(post_delete, sender=Message)
+def uncount_deleted_message(sender, instance, **kwargs):
+    UnreadCounter.refresh(instance.receiver_id, instance.sender_id)
+
+
+@receiver(post_save, sender=MessageAttachment)
+def reference_attachment(sender, instance, created, **kwargs):
+    if created:
+        GenericFileUpload.add_references([instance.attachment_id])
+
+
+@receiver(post_delete, sender=MessageAttachment)
+def release_attachment(sender, instance, **kwargs):
+    GenericFileUpload.release([instance.attachment_id])
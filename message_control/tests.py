@@ -2,8 +2,34 @@ from rest_framework.test import APITestCase
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from six import BytesIO
+from io import StringIO
 from PIL import Image
+from django.db import connection
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from .models import ChunkedUpload, Conversation, GenericFileUpload, Message, MessageAttachment, ReadCursor, UnreadCounter, UnreadTotal
+from .notifications import NotificationDispatcher
+from .thumbnails import ThumbnailGenerator, thumbnail_generator
+from .media_urls import MediaUrlCache, media_url_cache
+from .search import message_index
+from .serializers import GenericFileUploadSerializer
+from .realtime import SubscriptionRegistry, LocalBroker, subscriptions, websocket_application
+from asgiref.testing import ApplicationCommunicator
+from django.test import SimpleTestCase, override_settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from chatapi.storage_backends import CachedStorage
+from unittest import mock
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
 import json
+from datetime import timedelta
 
 
 def create_image(storage, filename, size=(100, 100), image_mode='RGB', image_format='PNG'):
@@ -130,6 +156,32 @@ class TestMessage(APITestCase):
         self.assertEqual(result["message_attachments"]
                          [0]["caption"], "nice stuff")
 
+    def test_messages_with_attachments_are_published(self):
+        upload = GenericFileUpload.objects.create(file_upload="poster.png")
+        payload = {
+            "sender_id": self.sender.id,
+            "receiver_id": self.receiver.id,
+            "message": "with poster",
+            "attachments": [{"attachment_id": upload.id}],
+        }
+        with mock.patch("message_control.views.subscriptions.publish") as publish, \
+                mock.patch("message_control.views.notification_dispatcher.submit_many"):
+            response = self.client.post(self.message_url, data=json.dumps(
+                payload), content_type='application/json', **self.bearer)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.json()["message_attachments"]), 1)
+
+            response = self.client.patch(self.message_url+f"/{response.json()['id']}", data=json.dumps({
+                "attachments": [{"attachment_id": upload.id}]}),
+                content_type='application/json', **self.bearer)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(publish.call_count, 2)
+        for call in publish.call_args_list:
+            receiver_id, notification = call.args
+            self.assertEqual(receiver_id, self.receiver.id)
+            self.assertEqual(notification["message"], "with poster")
+
     def test_update_message(self):
 
         # create message
@@ -179,3 +231,1310 @@ class TestMessage(APITestCase):
         result = response.json()
 
         self.assertEqual(response.status_code, 200)
+
+    def test_get_message_thread(self):
+        from user_control.models import CustomUser
+        other = CustomUser.objects._create_user(
+            "other", "other123", email="ekrem15@yahoo.com")
+        Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="to")
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="from")
+        Message.objects.create(
+            sender=other, receiver=self.sender, message="elsewhere")
+
+        self.assertEqual(Message.objects.first().conversation_key,
+                         f"{self.sender.id}:{other.id}")
+
+        response = self.client.get(
+            self.message_url+f"?user_id={self.receiver.id}", **self.bearer)
+        result = response.json()["results"]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m["message"] for m in result], ["from", "to"])
+
+    def test_get_message_cursor_pagination(self):
+        for i in range(25):
+            Message.objects.create(
+                sender=self.receiver, receiver=self.sender, message=f"{i}")
+        url = self.message_url+f"?user_id={self.receiver.id}"
+
+        response = self.client.get(url + "&cursor=", **self.bearer)
+        result = response.json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("count", result)
+        self.assertEqual(len(result["results"]), 20)
+        self.assertEqual(result["results"][0]["message"], "24")
+        self.assertIsNone(result["previous"])
+
+        response = self.client.get(result["next"], **self.bearer)
+        result = response.json()
+
+        self.assertEqual([m["message"] for m in result["results"]],
+                         ["4", "3", "2", "1", "0"])
+        self.assertIsNone(result["next"])
+        self.assertTrue(result["previous"])
+
+        # page numbers stay the default
+        result = self.client.get(url, **self.bearer).json()
+        self.assertEqual(result["count"], 25)
+        response = self.client.get(url + "&page=2", **self.bearer)
+        result = response.json()
+
+        self.assertEqual(result["count"], 25)
+        self.assertEqual(len(result["results"]), 5)
+
+    def create_receivers(self, count):
+        from user_control.models import CustomUser, UserProfile
+        receivers = []
+        for i in range(count):
+            user = CustomUser.objects._create_user(
+                f"batch{i}", "batch123", email=f"batch{i}@yahoo.com")
+            UserProfile.objects.create(
+                first_name="batch", last_name=f"{i}", user=user, caption="batch", about="batch")
+            receivers.append(user.id)
+        return receivers
+
+    def test_send_multiple_messages(self):
+        receivers = self.create_receivers(3)
+        upload = GenericFileUpload.objects.create(file_upload="batch.png")
+
+        payload = {
+            "message": "announcement",
+            "receiver_ids": receivers,
+            "attachments": [{"attachment_id": upload.id, "caption": "poster"}],
+        }
+        response = self.client.post("/message/send-messages", data=json.dumps(
+            payload), content_type='application/json', **self.bearer)
+        result = response.json()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([m["receiver"]["user"]["id"] for m in result], receivers)
+        self.assertTrue(all(m["message"] == "announcement" for m in result))
+        self.assertEqual(MessageAttachment.objects.count(), 3)
+        self.assertEqual(Message.objects.get(receiver_id=receivers[2]).conversation_key,
+                         Message.get_conversation_key(self.sender.id, receivers[2]))
+        self.assertEqual(len(self.search("q=announcement")), 3)
+
+    def send_to_many(self, count):
+        from user_control.models import CustomUser, UserProfile
+        start = CustomUser.objects.count()
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f"many{start + i}", email=f"many{start + i}@yahoo.com")
+            for i in range(count)])
+        users = list(CustomUser.objects.order_by("-id")[:count])
+        UserProfile.objects.bulk_create([
+            UserProfile(user=user, first_name="many", last_name="many", caption="", about="")
+            for user in users])
+        # half of them already have a conversation with the sender
+        Message.objects.bulk_create([
+            Message(sender=user, receiver=self.sender, message="earlier",
+                    conversation_key=Message.get_conversation_key(user.id, self.sender.id))
+            for user in users[::2]])
+        Conversation.record(Message.objects.filter(receiver=self.sender))
+
+        payload = json.dumps({"message": "announcement", "receiver_ids": [user.id for user in users]})
+        with mock.patch("message_control.views.notification_dispatcher.submit_many"), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/message/send-messages", data=payload,
+                                        content_type='application/json', **self.bearer)
+        self.assertEqual(response.status_code, 201)
+        return users, len(queries)
+
+    def test_send_to_many_receivers_constant_queries(self):
+        self.client.get("/user/me", **self.bearer)
+        _, few = self.send_to_many(10)
+        users, many = self.send_to_many(100)
+        self.assertEqual(few, many)
+
+        self.assertEqual(UnreadCounter.counts(users[0].id, [self.sender.id]), {self.sender.id: 1})
+        self.assertEqual(UnreadTotal.get(users[0].id), 1)
+        conversation = Conversation.objects.get(
+            key=Message.get_conversation_key(self.sender.id, users[0].id))
+        self.assertEqual(conversation.preview, "announcement")
+        self.assertEqual(conversation.get_unread_count(users[0].id), 1)
+        self.assertEqual(UnreadCounter.reconcile([user.id for user in users]), 0)
+
+    def test_send_multiple_distinct_messages(self):
+        payload = {
+            "messages": [
+                {"receiver_id": self.receiver.id, "message": "first"},
+                {"receiver_id": self.receiver.id, "message": "second"},
+            ]
+        }
+        response = self.client.post("/message/send-messages", data=json.dumps(
+            payload), content_type='application/json', **self.bearer)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([m["message"] for m in response.json()],
+                         ["first", "second"])
+
+        # nothing is written when any receiver is invalid
+        payload["messages"].append({"receiver_id": 9999, "message": "third"})
+        response = self.client.post("/message/send-messages", data=json.dumps(
+            payload), content_type='application/json', **self.bearer)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_send_multiple_messages_in_the_same_instant(self):
+        # rows only told apart by insertion order, next to an older one
+        now = timezone.now()
+        with mock.patch("django.utils.timezone.now", return_value=now):
+            older = Message.objects.create(
+                sender=self.sender, receiver=self.receiver, message="older")
+            response = self.client.post("/message/send-messages", data=json.dumps({
+                "messages": [
+                    {"receiver_id": self.receiver.id, "message": "first"},
+                    {"receiver_id": self.receiver.id, "message": "second"},
+                ]}), content_type='application/json', **self.bearer)
+
+        self.assertEqual(response.status_code, 201)
+        for message in response.json():
+            self.assertNotEqual(message["id"], older.id)
+            self.assertEqual(Message.objects.get(id=message["id"]).message, message["message"])
+
+    def search(self, query):
+        response = self.client.get(
+            "/message/search?" + query, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def test_search_messages(self):
+        from user_control.models import CustomUser, UserProfile
+        other = CustomUser.objects._create_user(
+            "other", "other123", email="ekrem15@yahoo.com")
+        UserProfile.objects.create(
+            first_name="other", last_name="other", user=other, caption="other", about="other")
+        first = Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="Hello there, how are you?")
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="hello hello hello")
+        Message.objects.create(
+            sender=other, receiver=self.sender, message="hellö from elsewhere")
+        Message.objects.create(
+            sender=other, receiver=self.receiver, message="hello, not for you")
+
+        results = self.search("q=hello")
+        self.assertEqual(results[0]["message"], "hello hello hello")
+        self.assertEqual({r["message"] for r in results[1:]}, {
+            "Hello there, how are you?", "hellö from elsewhere"})
+        snippets = {r["id"]: r["snippet"] for r in results}
+        self.assertIn("<b>Hello</b>", snippets[first.id])
+
+        results = self.search(f"q=hel&user_id={other.id}")
+        self.assertEqual([r["message"] for r in results], ["hellö from elsewhere"])
+
+        results = self.search('q="there how"')
+        self.assertEqual([r["id"] for r in results], [first.id])
+
+        results = self.search("q=hello&since=2999-01-01")
+        self.assertEqual(results, [])
+
+        # edits and deletes keep the index in sync
+        first.message = "goodbye"
+        first.save()
+        self.assertEqual(len(self.search("q=hello")), 2)
+        self.assertEqual(len(self.search("q=goodbye")), 1)
+        first.delete()
+        self.assertEqual(self.search("q=goodbye"), [])
+
+        response = self.client.get("/message/search", **self.bearer)
+        self.assertEqual(response.status_code, 400)
+
+    def test_rebuild_message_search(self):
+        Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="indexed")
+        Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="")
+
+        out = StringIO()
+        call_command("rebuild_message_search", chunk_size=1, stdout=out)
+
+        self.assertIn("indexed 1 messages", out.getvalue())
+        self.assertEqual(len(self.search("q=indexed")), 1)
+
+    def test_rebuild_keeps_concurrent_writes(self):
+        first = Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="hello first")
+        second = Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="hello second")
+
+        def chunks():
+            yield [(first.id, {"message": first.message})]
+            # written while the rebuild copies, after first was copied
+            first.message = "goodbye"
+            first.save()
+            second.delete()
+            yield []
+
+        message_index.rebuild(chunks())
+        self.assertEqual([m["id"] for m in self.search("q=goodbye")], [first.id])
+        self.assertEqual(self.search("q=hello"), [])
+
+        # writes after the rebuild go to the live table only
+        Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="hello again")
+        self.assertEqual(len(self.search("q=hello")), 1)
+
+    def create_thread(self, count):
+        upload = GenericFileUpload.objects.create(file_upload="thread.png")
+        for i in range(count):
+            message = Message.objects.create(
+                sender=self.receiver, receiver=self.sender, message=f"{i}")
+            MessageAttachment.objects.create(
+                message=message, attachment=upload)
+
+    def get_thread_queries(self):
+        url = self.message_url+f"?user_id={self.receiver.id}"
+        # warm up auth caches so only the page itself is measured
+        self.client.get(url, **self.bearer)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"], len(queries)
+
+    def test_get_message_constant_queries(self):
+        self.create_thread(2)
+        results, small_page = self.get_thread_queries()
+        self.assertEqual(len(results), 2)
+
+        self.create_thread(10)
+        results, full_page = self.get_thread_queries()
+        self.assertEqual(len(results), 12)
+        self.assertEqual(small_page, full_page)
+
+        # unread count of the receiver as seen by the sender
+        self.assertEqual(results[0]["sender"]["message_count"], 12)
+        self.assertEqual(results[0]["receiver"]["message_count"], 0)
+
+    def test_read_messages_advances_cursor(self):
+        first = Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="first")
+        second = Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="second")
+        Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="mine")
+
+        response = self.client.post("/message/read-messages", data=json.dumps(
+            {"message_ids": [first.id]}), content_type='application/json', **self.bearer)
+        self.assertEqual(response.status_code, 200)
+
+        cursor = ReadCursor.objects.get(user=self.sender, peer=self.receiver)
+        self.assertEqual(cursor.last_read_at, first.created_at)
+        # rows are left alone, the cursor alone marks them read
+        self.assertFalse(Message.objects.get(id=first.id).is_read)
+        self.assertEqual(list(Message.objects.unread(self.sender.id)), [second])
+        # the cursor is read up front, messages are counted as a range
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Message.objects.unread(self.sender.id, [self.receiver.id]).count(), 1)
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn("EXISTS", queries[1]["sql"])
+
+        results, _ = self.get_thread_queries()
+        self.assertEqual({m["message"]: m["is_read"] for m in results},
+                         {"first": True, "second": False, "mine": False})
+        self.assertEqual(results[0]["sender"]["message_count"], 0)
+        self.assertEqual(results[0]["receiver"]["message_count"], 1)
+
+        # an older read never moves the cursor back
+        ReadCursor.advance(self.sender.id, self.receiver.id,
+                           first.created_at - timedelta(days=1))
+        cursor.refresh_from_db()
+        self.assertEqual(cursor.last_read_at, first.created_at)
+
+    def test_is_read_flag_counts_as_read(self):
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="old", is_read=True)
+        unread = Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="new")
+        self.assertEqual(UnreadCounter.counts(self.sender.id, [self.receiver.id]),
+                         {self.receiver.id: 1})
+        self.assertEqual(UnreadCounter.reconcile([self.sender.id]), 0)
+
+        # the legacy flag clears the badge as well
+        response = self.client.patch(self.message_url+f"/{unread.id}", data={
+            "is_read": True}, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(UnreadCounter.counts(self.sender.id, [self.receiver.id]), {})
+        self.assertEqual(UnreadTotal.get(self.sender.id), 0)
+
+    def test_unread_with_many_cursors(self):
+        from user_control.models import CustomUser
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f"peer{i}", email=f"peer{i}@yahoo.com")
+            for i in range(1500)])
+        peers = list(CustomUser.objects.filter(username__startswith="peer"))
+        read = Message.objects.create(
+            sender=peers[0], receiver=self.sender, message="read")
+        Message.objects.create(sender=peers[0], receiver=self.sender, message="new")
+        Message.objects.create(sender=peers[1], receiver=self.sender, message="new")
+        Message.objects.create(sender=self.receiver, receiver=self.sender, message="new")
+        # written directly, the counters still include the read message
+        ReadCursor.objects.bulk_create([
+            ReadCursor(user=self.sender, peer=peer, last_read_at=read.created_at
+                       if peer == peers[0] else read.created_at - timedelta(days=1))
+            for peer in peers])
+
+        expected = {peers[0].id: 1, peers[1].id: 1, self.receiver.id: 1}
+        self.assertEqual(Message.objects.unread_counts(self.sender.id), expected)
+        self.assertEqual(UnreadCounter.reconcile([self.sender.id]), 1)
+        self.assertEqual(UnreadCounter.counts(self.sender.id, list(expected)), expected)
+
+    def test_read_conversation(self):
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="first")
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="second")
+
+        response = self.client.post("/message/read-conversation", data={
+            "user_id": self.receiver.id}, **self.bearer)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Message.objects.unread(self.sender.id).count(), 0)
+        self.assertEqual(Message.objects.unread_counts(
+            self.sender.id, [self.receiver.id]), {})
+
+        response = self.client.post(
+            "/message/read-conversation", data={}, **self.bearer)
+        self.assertEqual(response.status_code, 400)
+
+        # an unknown peer is not a conversation
+        response = self.client.post("/message/read-conversation", data={
+            "user_id": self.receiver.id + 100}, **self.bearer)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(ReadCursor.objects.filter(peer_id=self.receiver.id + 100).exists())
+
+    def get_unread_count(self, query=""):
+        response = self.client.get(
+            "/message/unread-count" + query, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["unread_count"]
+
+    def test_unread_counters(self):
+        receivers = self.create_receivers(2)
+        first = Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="first")
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="second")
+        for receiver_id in receivers:
+            response = self.client.post("/message/send-messages", data=json.dumps({
+                "messages": [{"receiver_id": self.sender.id, "message": "hi"}]
+            }), content_type='application/json', HTTP_AUTHORIZATION=self.login(receiver_id))
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.get_unread_count(), 4)
+        self.assertEqual(self.get_unread_count(f"?user_id={self.receiver.id}"), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(UnreadTotal.get(self.sender.id), 4)
+
+        self.client.post("/message/read-messages", data=json.dumps(
+            {"message_ids": [first.id]}), content_type='application/json', **self.bearer)
+        self.assertEqual(self.get_unread_count(f"?user_id={self.receiver.id}"), 1)
+        self.assertEqual(self.get_unread_count(), 3)
+
+        Message.objects.filter(sender_id=receivers[0]).get().delete()
+        self.assertEqual(self.get_unread_count(), 2)
+
+        self.client.post("/message/read-conversation", data={
+            "user_id": self.receiver.id}, **self.bearer)
+        self.assertEqual(self.get_unread_count(), 1)
+
+        # drifted counters are repaired from the messages
+        UnreadCounter.objects.update(count=7)
+        UnreadTotal.objects.update(count=7)
+        out = StringIO()
+        call_command("reconcile_unread_counters", chunk_size=2, stdout=out)
+
+        self.assertIn("3 corrected", out.getvalue())
+        self.assertEqual(self.get_unread_count(), 1)
+        self.assertEqual(self.get_unread_count(f"?user_id={receivers[1]}"), 1)
+        self.assertEqual(self.get_unread_count(f"?user_id={self.receiver.id}"), 0)
+        conversation = Conversation.objects.get(
+            key=Message.get_conversation_key(self.sender.id, receivers[1]))
+        self.assertEqual(conversation.get_unread_count(self.sender.id), 1)
+
+    def get_inbox(self, url="/message/inbox"):
+        self.client.get(url, **self.bearer)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_inbox(self):
+        receivers = self.create_receivers(3)
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="old")
+        payload = {"message": "latest news", "receiver_ids": receivers[:2]}
+        self.client.post("/message/send-messages", data=json.dumps(
+            payload), content_type='application/json', **self.bearer)
+        response = self.client.post(self.message_url, data={
+            "sender_id": self.sender.id, "receiver_id": self.receiver.id,
+            "message": "x" * 150}, **self.bearer)
+        last_id = response.json()["id"]
+
+        result, small_inbox = self.get_inbox()
+        conversations = result["results"]
+        self.assertEqual([c["peer"]["id"] for c in conversations],
+                         [self.receiver.id, receivers[1], receivers[0]])
+        self.assertEqual(conversations[0]["last_message"], last_id)
+        self.assertEqual(conversations[0]["preview"], "x" * 100)
+        self.assertEqual(conversations[0]["unread_count"], 1)
+        self.assertEqual(conversations[0]["peer"]["username"], "receiver")
+        self.assertEqual(conversations[1]["unread_count"], 0)
+
+        for receiver_id in receivers[2:]:
+            Message.objects.create(
+                sender_id=receiver_id, receiver=self.sender, message="hi")
+        result, full_inbox = self.get_inbox()
+        self.assertEqual(len(result["results"]), 4)
+        self.assertEqual(small_inbox, full_inbox)
+
+        # edits and deletes of the last message are reflected
+        Message.objects.filter(id=last_id).get().delete()
+        conversation = Conversation.objects.get(
+            key=Message.get_conversation_key(self.sender.id, self.receiver.id))
+        self.assertEqual(conversation.preview, "old")
+        self.client.patch(self.message_url+f"/{conversation.last_message_id}",
+                          data={"message": "edited"}, **self.bearer)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.preview, "edited")
+
+        # the receiver sees the same conversations from the other side
+        response = self.client.get("/message/inbox", HTTP_AUTHORIZATION=self.login(receivers[0]))
+        conversations = response.json()["results"]
+        self.assertEqual([c["peer"]["id"] for c in conversations], [self.sender.id])
+        self.assertEqual(conversations[0]["unread_count"], 1)
+
+    def test_thread_etag(self):
+        url = self.message_url+f"?user_id={self.receiver.id}"
+        message = Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="hello")
+        response = self.client.get(url, **self.bearer)
+        etag = response["ETag"]
+
+        # answered from the version counters alone
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([query for query in queries.captured_queries
+                          if '"message_control_message"' in query["sql"]])
+
+        def refetched():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.bearer)
+            self.assertEqual(response.status_code, 200)
+            return response["ETag"]
+
+        self.client.patch(self.message_url+f"/{message.id}", data={
+            "message": "hello again"}, **self.bearer)
+        etag = refetched()
+        Message.objects.create(
+            sender=self.receiver, receiver=self.sender, message="hi")
+        etag = refetched()
+        self.client.post("/message/read-conversation", data={
+            "user_id": self.receiver.id}, **self.bearer)
+        etag = refetched()
+        self.receiver.user_profile.save()
+        etag = refetched()
+
+        # other pages and other viewers have their own tags
+        response = self.client.get(url+"&page=1", HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+
+    def test_inbox_cursor_pagination(self):
+        receivers = self.create_receivers(25)
+        for receiver_id in receivers:
+            Message.objects.create(
+                sender=self.sender, receiver_id=receiver_id, message="hi")
+
+        response = self.client.get("/message/inbox", **self.bearer)
+        result = response.json()
+        self.assertEqual(len(result["results"]), 20)
+        self.assertEqual(result["results"][0]["peer"]["id"], receivers[-1])
+
+        result = self.client.get(result["next"], **self.bearer).json()
+        self.assertEqual([c["peer"]["id"] for c in result["results"]],
+                         receivers[4::-1])
+
+    def login(self, user_id):
+        from user_control.models import CustomUser
+        user = CustomUser.objects.get(id=user_id)
+        response = self.client.post(self.login_url, data={
+            "username": user.username, "password": "batch123"})
+        return 'Bearer {}'.format(response.json()['access'])
+
+
+class TestBenchmarkCommand(APITestCase):
+
+    def test_benchmark_message_indexes(self):
+        out = StringIO()
+        call_command("benchmark_message_indexes", rows=200,
+                     users=5, repeat=1, stdout=out)
+
+        self.assertIn("message_conversation_idx", out.getvalue())
+        self.assertIn("message_unread_idx", out.getvalue())
+        self.assertFalse(Message.objects.exists())
+
+
+class TestNotificationDispatcher(SimpleTestCase):
+
+    def setUp(self):
+        self.received = []
+        received = self.received
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                received.append(json.loads(self.rfile.read(length)))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%s" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_queued_notifications_are_batched(self):
+        dispatcher = NotificationDispatcher(url=self.url, workers=0)
+        for i in range(3):
+            dispatcher.submit({"message": i})
+
+        batch = dispatcher.next_batch(block=False)
+        self.assertTrue(dispatcher.send(batch))
+        self.assertEqual(self.received, [
+            [{"message": 0}, {"message": 1}, {"message": 2}]])
+
+        dispatcher.submit({"message": 3})
+        dispatcher.send(dispatcher.next_batch(block=False))
+        self.assertEqual(self.received[-1], {"message": 3})
+
+    def test_request_is_queued_as_one_payload(self):
+        dispatcher = NotificationDispatcher(
+            url=self.url, workers=0, queue_size=2, batch_size=2)
+        self.assertEqual(dispatcher.submit_many(
+            [{"message": i} for i in range(5)]), 5)
+        self.assertEqual(dispatcher.stats()["queued"], 1)
+        dispatcher.submit({"message": 5})
+
+        dispatcher.send(dispatcher.next_batch(block=False))
+        self.assertEqual(self.received, [[{"message": i} for i in range(5)]])
+        self.assertEqual(dispatcher.next_batch(block=False), [{"message": 5}])
+
+    def test_full_queue_sheds_load(self):
+        dispatcher = NotificationDispatcher(
+            url=self.url, workers=0, queue_size=1)
+
+        self.assertTrue(dispatcher.submit({"message": 0}))
+        self.assertFalse(dispatcher.submit({"message": 1}))
+        self.assertEqual(dispatcher.stats()["dropped"], 1)
+        self.assertEqual(dispatcher.submit_many([{"message": 2}, {"message": 3}]), 0)
+        self.assertEqual(dispatcher.stats()["dropped"], 3)
+
+    def test_unreachable_server_is_retried(self):
+        dispatcher = NotificationDispatcher(
+            url="http://127.0.0.1:9", workers=0, max_retries=2, backoff=0)
+
+        self.assertFalse(dispatcher.send([{"message": 0}]))
+
+    def test_workers_deliver_in_background(self):
+        dispatcher = NotificationDispatcher(url=self.url, workers=1)
+        dispatcher.submit({"message": 0})
+
+        for _ in range(100):
+            if dispatcher.stats()["sent"]:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(dispatcher.stats()["sent"], 1)
+        self.assertEqual(self.received, [{"message": 0}])
+
+
+class TestRealtime(APITestCase):
+
+    def get_communicator(self, query_string):
+        return ApplicationCommunicator(websocket_application, {
+            "type": "websocket", "path": "/ws", "headers": [],
+            "query_string": query_string,
+        })
+
+    async def test_websocket_receives_published_messages(self):
+        from user_control.views import get_access_token
+        token = get_access_token({"user_id": 4242}).decode()
+
+        communicator = self.get_communicator(f"token={token}".encode())
+        await communicator.send_input({"type": "websocket.connect"})
+        self.assertEqual((await communicator.receive_output())["type"],
+                         "websocket.accept")
+
+        # published from another thread, as MessageView does
+        thread = threading.Thread(
+            target=subscriptions.publish, args=(4242, {"message": "hi"}))
+        thread.start()
+        thread.join()
+
+        output = await communicator.receive_output()
+        self.assertEqual(json.loads(output["text"]), {"message": "hi"})
+
+        await communicator.send_input({"type": "websocket.disconnect"})
+        await communicator.wait()
+        self.assertFalse(subscriptions.is_connected(4242))
+
+    async def test_websocket_rejects_invalid_token(self):
+        communicator = self.get_communicator(b"token=invalid")
+        await communicator.send_input({"type": "websocket.connect"})
+
+        output = await communicator.receive_output()
+        self.assertEqual(output, {"type": "websocket.close", "code": 4001})
+
+    def test_registry_publishes_through_broker(self):
+        broker = LocalBroker()
+        registry = SubscriptionRegistry(broker=broker)
+        # stands in for a registry living in another process
+        received = []
+        broker.subscribe(lambda user_id, payload: received.append(
+            (user_id, payload)))
+
+        registry.publish(1, {"message": "hi"})
+        self.assertEqual(received, [(1, {"message": "hi"})])
+
+    def test_socket_server_only_gets_unserved_notifications(self):
+        from .views import notify
+        registry = SubscriptionRegistry()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def connect():
+            return registry.subscribe(1)
+        subscription = loop.run_until_complete(connect())
+
+        with mock.patch("message_control.views.subscriptions", registry), \
+                mock.patch("message_control.views.notification_dispatcher.submit_many") as submit_many:
+            notify([(1, {"message": "here"}), (2, {"message": "elsewhere"})])
+        submit_many.assert_called_once_with([{"message": "elsewhere"}])
+
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(subscription[1].get_nowait(), {"message": "here"})
+
+        # a shared broker reaches every process, nothing is posted
+        with mock.patch("message_control.views.subscriptions",
+                        SubscriptionRegistry(broker=LocalBroker())), \
+                mock.patch("message_control.views.notification_dispatcher.submit_many") as submit_many:
+            notify([(2, {"message": "elsewhere"})])
+        submit_many.assert_not_called()
+
+    def test_broker_or_socket_server_required(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from .realtime import get_broker
+        with override_settings(REALTIME_BROKER=None, SOCKET_SERVER="http://socket"):
+            self.assertIsNone(get_broker())
+        with override_settings(REALTIME_BROKER="message_control.realtime.LocalBroker",
+                               SOCKET_SERVER=""):
+            self.assertIsInstance(get_broker(), LocalBroker)
+        with override_settings(REALTIME_BROKER=None, SOCKET_SERVER=""):
+            with self.assertRaises(ImproperlyConfigured):
+                get_broker()
+
+
+@override_settings(DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage")
+class TestChunkedUpload(APITestCase):
+    upload_url = "/message/chunked-upload"
+    login_url = "/user/login"
+
+    def setUp(self):
+        from user_control.models import CustomUser
+        payload = {
+            "username": "uploader",
+            "password": "uploader123",
+            "email": "uploader@yahoo.com"
+        }
+        CustomUser.objects._create_user(**payload)
+        response = self.client.post(self.login_url, data=payload)
+        self.bearer = {
+            'HTTP_AUTHORIZATION': 'Bearer {}'.format(response.json()['access'])}
+
+        media_root = tempfile.mkdtemp()
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.addCleanup(shutil.rmtree, upload_dir)
+        settings = override_settings(MEDIA_ROOT=media_root, CHUNKED_UPLOAD_DIR=upload_dir,
+                                     CHUNKED_UPLOAD_MAX_CHUNK_SIZE=6)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.upload_dir = upload_dir
+
+    def put_chunk(self, upload_id, offset, data):
+        return self.client.put(f"{self.upload_url}/{upload_id}?offset={offset}", data=data,
+                               content_type="application/octet-stream", **self.bearer)
+
+    def test_chunked_upload(self):
+        response = self.client.post(self.upload_url, data={
+            "filename": "../notes.txt", "size": 11}, **self.bearer)
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()["id"]
+        self.assertEqual(response.json()["filename"], "notes.txt")
+
+        response = self.put_chunk(upload_id, 0, b"hello ")
+        self.assertEqual(response.json()["offset"], 6)
+
+        # chunks must continue where the last one ended
+        response = self.put_chunk(upload_id, 0, b"hello ")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 6)
+
+        response = self.put_chunk(upload_id, 6, b"world, and more")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            f"{self.upload_url}/{upload_id}/complete", **self.bearer)
+        self.assertEqual(response.status_code, 400)
+
+        # an interrupted upload asks where to resume
+        response = self.client.get(f"{self.upload_url}/{upload_id}", **self.bearer)
+        self.assertEqual(response.json()["offset"], 6)
+        self.put_chunk(upload_id, 6, b"world")
+
+        response = self.client.post(
+            f"{self.upload_url}/{upload_id}/complete", **self.bearer)
+        self.assertEqual(response.status_code, 201)
+
+        upload = GenericFileUpload.objects.get(id=response.json()["id"])
+        self.assertEqual(upload.file_upload.read(), b"hello world")
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+        # completing again is harmless
+        response = self.client.post(
+            f"{self.upload_url}/{upload_id}/complete", **self.bearer)
+        self.assertEqual(response.json()["id"], upload.id)
+        self.assertEqual(GenericFileUpload.objects.count(), 1)
+
+    def test_abandoned_uploads_are_cleared(self):
+        response = self.client.post(self.upload_url, data={
+            "filename": "big.bin", "size": 100}, **self.bearer)
+        upload_id = response.json()["id"]
+        self.put_chunk(upload_id, 0, b"abc")
+
+        ChunkedUpload.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        out = StringIO()
+        call_command("clear_chunked_uploads", stdout=out)
+
+        self.assertIn("cleared 1 uploads", out.getvalue())
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_multipart_upload_behind_media_cache(self):
+        from storages.backends.s3boto3 import S3Boto3Storage
+        from chatapi.storage_backends import MediaStorage
+        backend = MediaStorage()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        storage = CachedStorage(backend=backend, location=cache_dir)
+
+        bucket = mock.MagicMock()
+        bucket.name = "media"
+        client = bucket.meta.client
+        client.create_multipart_upload.return_value = {"UploadId": "multipart"}
+        client.upload_part.return_value = {"ETag": '"part"'}
+        with mock.patch("message_control.views.get_upload_storage", return_value=storage), \
+                mock.patch.object(S3Boto3Storage, "bucket", bucket), \
+                mock.patch.object(backend, "exists", return_value=False), \
+                mock.patch.object(backend, "url", return_value="https://media/notes.txt"):
+            response = self.client.post(self.upload_url, data={
+                "filename": "notes.txt", "size": 5}, **self.bearer)
+            upload_id = response.json()["id"]
+            self.assertEqual(self.put_chunk(upload_id, 0, b"hello").json()["offset"], 5)
+            response = self.client.post(
+                f"{self.upload_url}/{upload_id}/complete", **self.bearer)
+
+        self.assertEqual(response.status_code, 201)
+        client.create_multipart_upload.assert_called_once()
+        self.assertEqual(client.upload_part.call_args.kwargs["Key"], "media/notes.txt")
+        client.complete_multipart_upload.assert_called_once_with(
+            Bucket="media", Key="media/notes.txt", UploadId="multipart",
+            MultipartUpload={"Parts": [{"PartNumber": 1, "ETag": '"part"'}]})
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+
+@override_settings(DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage")
+class TestThumbnails(APITestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media_root = media_root
+
+    def create_upload(self, filename, size=(1000, 500)):
+        return GenericFileUpload.objects.create(
+            file_upload=create_image(default_storage, filename, size))
+
+    def test_generate_thumbnails(self):
+        upload = self.create_upload("photo.png")
+        generator = ThumbnailGenerator(processes=1)
+        self.addCleanup(lambda: generator._pool.shutdown())
+
+        variants = generator.generate(upload.id)
+
+        self.assertEqual(set(variants), {"thumbnail", "preview"})
+        with default_storage.open(variants["thumbnail"]) as thumbnail:
+            self.assertEqual(Image.open(thumbnail).size, (128, 64))
+        with default_storage.open(variants["preview"]) as preview:
+            self.assertEqual(Image.open(preview).size, (640, 320))
+
+        response = self.client.get(f"/message/file-upload/{upload.id}")
+        self.assertEqual(response.json()["variants"]["thumbnail"],
+                         default_storage.url(variants["thumbnail"]))
+
+        # running again replaces the files under the same names
+        files = sorted(os.listdir(self.media_root))
+        self.assertEqual(generator.generate(upload.id, force=True), variants)
+        self.assertEqual(sorted(os.listdir(self.media_root)), files)
+
+    def test_variants_never_touch_other_files(self):
+        # an unrelated upload named like the variant of another one
+        other = GenericFileUpload.objects.create(file_upload=default_storage.save(
+            "cat_thumbnail.jpg", ContentFile(b"someone else's")))
+        upload = self.create_upload("cat.jpg")
+        generator = ThumbnailGenerator(processes=0)
+
+        first = generator.generate(upload.id)
+        self.assertNotIn("cat_thumbnail.jpg", first.values())
+        second = generator.generate(upload.id, force=True)
+        self.assertEqual(second, first)
+
+        with default_storage.open(other.file_upload.name) as file:
+            self.assertEqual(file.read(), b"someone else's")
+        duplicate = self.create_upload("cat.jpg")
+        self.assertFalse(set(generator.generate(duplicate.id).values()) & set(first.values()))
+        self.assertTrue(all(default_storage.exists(name) for name in first.values()))
+
+    def test_generate_thumbnails_command(self):
+        self.create_upload("first.png")
+        self.create_upload("second.jpg")
+        GenericFileUpload.objects.create(
+            file_upload=default_storage.save("notes.txt", ContentFile(b"notes")))
+
+        out = StringIO()
+        with mock.patch.object(thumbnail_generator, "processes", 0):
+            call_command("generate_thumbnails", chunk_size=2, stdout=out)
+            self.assertIn("generated variants of 2 uploads", out.getvalue())
+
+            call_command("generate_thumbnails", stdout=out)
+            self.assertIn("generated variants of 0 uploads", out.getvalue())
+
+        self.assertEqual(GenericFileUpload.objects.filter(variants={}).count(), 1)
+
+
+@override_settings(DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage")
+class TestUploadDeduplication(APITestCase):
+    file_upload_url = "/message/file-upload"
+    message_url = "/message/message"
+    login_url = "/user/login"
+
+    def setUp(self):
+        from user_control.models import CustomUser, UserProfile
+        payload = {
+            "username": "forwarder",
+            "password": "forwarder123",
+            "email": "forwarder@yahoo.com"
+        }
+        self.sender = CustomUser.objects._create_user(**payload)
+        UserProfile.objects.create(
+            first_name="forwarder", last_name="forwarder", user=self.sender, caption="forwarder", about="forwarder")
+        response = self.client.post(self.login_url, data=payload)
+        self.bearer = {
+            'HTTP_AUTHORIZATION': 'Bearer {}'.format(response.json()['access'])}
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root,
+                                     CHUNKED_UPLOAD_DIR=tempfile.mkdtemp(dir=media_root))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media_root = media_root
+
+    def upload(self, name, content):
+        response = self.client.post(self.file_upload_url, data={
+            "file_upload": SimpleUploadedFile(name, content)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()["id"]
+
+    def send(self, upload_id):
+        payload = {
+            "sender_id": self.sender.id,
+            "receiver_id": self.sender.id,
+            "message": "forwarded",
+            "attachments": [{"attachment_id": upload_id}],
+        }
+        response = self.client.post(self.message_url, data=json.dumps(
+            payload), content_type='application/json', **self.bearer)
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()["id"]
+
+    def stored_files(self):
+        return sorted(name for name in os.listdir(self.media_root)
+                      if os.path.isfile(os.path.join(self.media_root, name)))
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.upload("cat.gif", b"GIF89a same bytes")
+        second = self.upload("forwarded.gif", b"GIF89a same bytes")
+        other = self.upload("dog.gif", b"GIF89a other bytes")
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEqual(self.stored_files(), ["cat.gif", "dog.gif"])
+        self.assertEqual(GenericFileUpload.objects.get(id=first).digest,
+                         hashlib.sha256(b"GIF89a same bytes").hexdigest())
+
+        # a chunked upload of the same content is answered the same way
+        response = self.client.post("/message/chunked-upload", data={
+            "filename": "again.gif", "size": 17}, **self.bearer)
+        upload_id = response.json()["id"]
+        self.client.put(f"/message/chunked-upload/{upload_id}?offset=0", data=b"GIF89a same bytes",
+                        content_type="application/octet-stream", **self.bearer)
+        response = self.client.post(
+            f"/message/chunked-upload/{upload_id}/complete", **self.bearer)
+        self.assertEqual(response.json()["id"], first)
+        self.assertEqual(self.stored_files(), ["cat.gif", "dog.gif"])
+
+    def test_files_are_deleted_with_their_last_reference(self):
+        upload_id = self.upload("cat.gif", b"GIF89a forwarded")
+        first = self.send(upload_id)
+        second = self.send(upload_id)
+        self.assertEqual(GenericFileUpload.objects.get(id=upload_id).ref_count, 2)
+
+        with mock.patch("django.db.transaction.on_commit", side_effect=lambda callback: callback()):
+            self.client.delete(f"{self.message_url}/{first}", **self.bearer)
+            self.assertEqual(GenericFileUpload.objects.get(id=upload_id).ref_count, 1)
+            self.assertEqual(self.stored_files(), ["cat.gif"])
+
+            # an edit keeping the attachment keeps the file
+            response = self.client.patch(f"{self.message_url}/{second}", data=json.dumps({
+                "attachments": [{"attachment_id": upload_id}]
+            }), content_type='application/json', **self.bearer)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(GenericFileUpload.objects.get(id=upload_id).ref_count, 1)
+
+            self.client.delete(f"{self.message_url}/{second}", **self.bearer)
+            self.assertFalse(GenericFileUpload.objects.filter(id=upload_id).exists())
+            self.assertEqual(self.stored_files(), [])
+
+    def test_hash_uploads_merges_duplicates(self):
+        first = GenericFileUpload.objects.create(
+            file_upload=default_storage.save("one.gif", ContentFile(b"GIF89a legacy")))
+        second = GenericFileUpload.objects.create(
+            file_upload=default_storage.save("two.gif", ContentFile(b"GIF89a legacy")))
+        self.send(first.id)
+        self.send(second.id)
+
+        out = StringIO()
+        with mock.patch("django.db.transaction.on_commit", side_effect=lambda callback: callback()):
+            call_command("hash_uploads", stdout=out)
+
+        self.assertIn("hashed 2 uploads, merged 1 duplicates", out.getvalue())
+        self.assertFalse(GenericFileUpload.objects.filter(id=second.id).exists())
+        self.assertEqual(GenericFileUpload.objects.get(id=first.id).ref_count, 2)
+        self.assertEqual(MessageAttachment.objects.filter(attachment_id=first.id).count(), 2)
+        self.assertEqual(self.stored_files(), ["one.gif"])
+
+
+class SignedStorage:
+    querystring_auth = True
+    querystring_expire = 600
+    custom_domain = None
+
+    def __init__(self):
+        self.signed = []
+
+    def url(self, name):
+        self.signed.append(name)
+        return f"https://bucket.example.com/{name}?signature={len(self.signed)}"
+
+
+class TestMediaUrls(APITestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(
+            MEDIA_ROOT=media_root,
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage")
+        settings.enable()
+        self.addCleanup(settings.disable)
+        media_url_cache.clear()
+        self.addCleanup(media_url_cache.clear)
+
+    def test_signed_urls_are_reused_for_half_their_lifetime(self):
+        storage = SignedStorage()
+        cache = MediaUrlCache(max_size=2, ttl=3600)
+        self.assertEqual(cache.get_ttl(storage), 300)
+
+        with mock.patch("message_control.media_urls.time.monotonic", return_value=1000):
+            first = cache.resolve_many(storage, ["a.png", "b.png", "a.png"])
+            self.assertEqual(cache.resolve_many(storage, ["a.png"]), {"a.png": first["a.png"]})
+        self.assertEqual(storage.signed.count("a.png"), 1)
+
+        with mock.patch("message_control.media_urls.time.monotonic", return_value=1300):
+            self.assertNotEqual(cache.resolve_many(storage, ["a.png"]), {"a.png": first["a.png"]})
+            cache.resolve_many(storage, ["c.png"])
+        self.assertEqual(cache.stats()["size"], 2)
+
+        # unsigned urls do not expire with a signature
+        storage.custom_domain = "cdn.example.com"
+        self.assertEqual(cache.get_ttl(storage), 3600)
+
+    def test_serializer_resolves_each_name_once(self):
+        picture = default_storage.save("avatar.png", ContentFile(b"png"))
+        uploads = [GenericFileUpload.objects.create(file_upload=picture) for _ in range(3)]
+
+        with mock.patch.object(default_storage, "url", wraps=default_storage.url) as url:
+            data = GenericFileUploadSerializer(uploads, many=True).data
+            GenericFileUploadSerializer(GenericFileUpload.objects.all(), many=True).data
+
+        self.assertEqual(url.call_count, 1)
+        self.assertEqual({upload["file_upload"] for upload in data}, {"/media/avatar.png"})
+
+
+class TestCachedStorage(SimpleTestCase):
+
+    def setUp(self):
+        self.remote_root = tempfile.mkdtemp()
+        self.cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.remote_root)
+        self.addCleanup(shutil.rmtree, self.cache_root)
+        # a local directory stands in for S3
+        self.remote = FileSystemStorage(location=self.remote_root)
+
+    def get_storage(self, **kwargs):
+        return CachedStorage(backend=self.remote, location=self.cache_root, **kwargs)
+
+    def read(self, storage, name):
+        with storage.open(name) as file:
+            return file.read()
+
+    def test_reads_come_from_local_disk(self):
+        storage = self.get_storage(max_size=1024)
+        name = storage.save("photo.png", ContentFile(b"saved"))
+        self.remote.save("other.png", ContentFile(b"remote"))
+
+        with mock.patch.object(self.remote, "open", wraps=self.remote.open) as remote_open:
+            self.assertEqual(self.read(storage, name), b"saved")
+            self.assertEqual(self.read(storage, "other.png"), b"remote")
+            self.assertEqual(self.read(storage, "other.png"), b"remote")
+        # written through on save, read through once on a miss
+        self.assertEqual(remote_open.call_count, 1)
+        self.assertEqual(storage.stats()["hits"], 2)
+
+        # a new process starts with what is on disk
+        self.assertEqual(self.get_storage().stats()["files"], 2)
+
+        storage.delete(name)
+        self.assertFalse(self.remote.exists(name))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_root, name)))
+
+    def test_least_recently_used_files_are_evicted(self):
+        storage = self.get_storage(max_size=10)
+        for name in ("a.txt", "b.txt"):
+            storage.save(name, ContentFile(b"12345"))
+        self.read(storage, "a.txt")
+        storage.save("c.txt", ContentFile(b"12345"))
+
+        self.assertEqual(sorted(name for name in os.listdir(self.cache_root)
+                                if not name.endswith(".sha256")), ["a.txt", "c.txt"])
+        self.assertEqual(storage.stats()["size"], 10)
+        # still there behind the cache
+        self.assertEqual(self.read(storage, "b.txt"), b"12345")
+
+    def test_corrupt_copies_are_dropped(self):
+        storage = self.get_storage(verify=True)
+        storage.save("a.txt", ContentFile(b"original"))
+        storage.save("b.txt", ContentFile(b"original"))
+        with open(os.path.join(self.cache_root, "a.txt"), "wb") as file:
+            file.write(b"flipped!")
+
+        self.assertEqual(self.read(storage, "a.txt"), b"original")
+
+        with open(os.path.join(self.cache_root, "b.txt"), "wb") as file:
+            file.write(b"flipped!")
+        self.assertEqual(storage.check(), (2, ["b.txt"]))
+        self.assertEqual(self.read(storage, "b.txt"), b"original")
+
+
+@override_settings(DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage")
+class TestAttachmentDownload(APITestCase):
+    login_url = "/user/login"
+
+    def setUp(self):
+        from user_control.models import CustomUser
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root, DOWNLOAD_CHUNK_SIZE=4)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        sender = CustomUser.objects._create_user(
+            "sender", "sender123", email="sender@yahoo.com")
+        receiver = CustomUser.objects._create_user(
+            "receiver", "receiver123", email="receiver@yahoo.com")
+        CustomUser.objects._create_user(
+            "stranger", "stranger123", email="stranger@yahoo.com")
+
+        self.content = b"0123456789abcdef"
+        upload = GenericFileUpload.objects.create(file_upload=default_storage.save(
+            "clip.mp4", ContentFile(self.content)))
+        message = Message.objects.create(
+            sender=sender, receiver=receiver, message="clip")
+        self.attachment = MessageAttachment.objects.create(
+            message=message, attachment=upload)
+        self.url = f"/message/attachment/{self.attachment.id}/download"
+
+    def download(self, username="receiver", **headers):
+        response = self.client.post(self.login_url, data={
+            "username": username, "password": f"{username}123"})
+        return self.client.get(self.url, HTTP_AUTHORIZATION="Bearer {}".format(
+            response.json()["access"]), **headers)
+
+    def test_download(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertEqual(response["Content-Length"], "16")
+        self.assertEqual(response["Content-Type"], "video/mp4")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        response = self.download(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.download("stranger").status_code, 404)
+
+    def test_range(self):
+        response = self.download(HTTP_RANGE="bytes=5-9")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"56789")
+        self.assertEqual(response["Content-Range"], "bytes 5-9/16")
+
+        response = self.download(HTTP_RANGE="bytes=-3")
+        self.assertEqual(b"".join(response.streaming_content), b"def")
+        self.assertEqual(response["Content-Range"], "bytes 13-15/16")
+
+        response = self.download(HTTP_RANGE="bytes=10-")
+        self.assertEqual(b"".join(response.streaming_content), b"abcdef")
+
+        response = self.download(HTTP_RANGE="bytes=16-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */16")
+
+        # a range of an older version is not applied
+        response = self.download(HTTP_RANGE="bytes=5-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_ranged_get_from_s3(self):
+        from storages.backends.s3boto3 import S3Boto3Storage
+        from chatapi.storage_backends import MediaStorage
+        from .downloads import iter_range
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        storage = CachedStorage(backend=MediaStorage(), location=cache_dir, max_file_size=8)
+
+        bucket = mock.MagicMock()
+        body = bucket.Object.return_value.get.return_value["Body"]
+        body.iter_chunks.return_value = iter([b"567"])
+        with mock.patch.object(S3Boto3Storage, "bucket", bucket), \
+                mock.patch.object(storage, "open") as storage_open:
+            # a small range of an object too large for the cache
+            self.assertEqual(list(iter_range(storage, "clip.mp4", 5, 3, 16, 4)), [b"567"])
+            bucket.Object.assert_called_once_with("media/clip.mp4")
+            bucket.Object.return_value.get.assert_called_once_with(Range="bytes=5-7")
+            storage_open.assert_not_called()
+
+            # small objects are read through the cache
+            storage_open.return_value.__enter__.return_value = ContentFile(b"01234567")
+            self.assertEqual(b"".join(iter_range(storage, "small.mp4", 5, 3, 8, 4)), b"567")
+            self.assertEqual(bucket.Object.call_count, 1)
+
+    @override_settings(MEDIA_SENDFILE_HEADER="X-Accel-Redirect")
+    def test_sendfile(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/clip.mp4")
+        self.assertEqual(response.content, b"")
+
+
+@override_settings(SYNC_SETTLE_TIME=0)
+class TestMessageSync(APITestCase):
+    login_url = "/user/login"
+    sync_url = "/message/sync"
+
+    def setUp(self):
+        from user_control.models import CustomUser
+        self.sender = CustomUser.objects._create_user(
+            "sender", "sender123", email="sender@yahoo.com")
+        self.receiver = CustomUser.objects._create_user(
+            "receiver", "receiver123", email="receiver@yahoo.com")
+        self.bearers = {}
+        for user in (self.sender, self.receiver):
+            response = self.client.post(self.login_url, data={
+                "username": user.username, "password": f"{user.username}123"})
+            self.bearers[user.id] = {
+                'HTTP_AUTHORIZATION': 'Bearer {}'.format(response.json()['access'])}
+
+    def sync(self, user, since=None):
+        data = {"since": since} if since else {}
+        response = self.client.get(self.sync_url, data=data, **self.bearers[user.id])
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sync(self):
+        sender_mark = self.sync(self.sender)["watermark"]
+        receiver_mark = self.sync(self.receiver)["watermark"]
+
+        message = Message.objects.create(
+            sender=self.sender, receiver=self.receiver, message="hello")
+        result = self.sync(self.receiver, receiver_mark)
+        self.assertEqual([item["id"] for item in result["messages"]], [message.id])
+        self.assertNotIn("sender", result["messages"][0])
+        self.assertFalse(result["messages"][0]["is_read"])
+
+        # nothing new: one query over the changes and an empty answer
+        receiver_mark = result["watermark"]
+        with CaptureQueriesContext(connection) as queries:
+            result = self.sync(self.receiver, receiver_mark)
+        self.assertEqual(result["messages"], [])
+        self.assertEqual(result["reads"], [])
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if "message_control_" in query["sql"]]), 1)
+
+        # edits and reads both show up for the sender
+        message.message = "hello again"
+        message.save()
+        self.client.post("/message/read-conversation", data={
+            "user_id": self.sender.id}, **self.bearers[self.receiver.id])
+        result = self.sync(self.sender, sender_mark)
+        self.assertEqual(result["messages"][0]["message"], "hello again")
+        self.assertTrue(result["messages"][0]["is_read"])
+        self.assertEqual(result["reads"][0]["user_id"], self.receiver.id)
+
+        self.assertEqual(self.client.get(self.sync_url, data={"since": "yesterday"},
+                                         **self.bearers[self.sender.id]).status_code, 400)
+
+    @override_settings(SYNC_PAGE_SIZE=2)
+    def test_sync_pages(self):
+        mark = self.sync(self.receiver)["watermark"]
+        messages = [Message.objects.create(sender=self.sender, receiver=self.receiver,
+                                           message=str(i)) for i in range(3)]
+
+        result = self.sync(self.receiver, mark)
+        self.assertTrue(result["has_more"])
+        received = [item["id"] for item in result["messages"]]
+        result = self.sync(self.receiver, result["watermark"])
+        self.assertFalse(result["has_more"])
+        received += [item["id"] for item in result["messages"]]
+        self.assertEqual(received, [message.id for message in messages])
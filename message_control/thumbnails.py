@@ -0,0 +1,142 @@
+import logging
+import mimetypes
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from .media_urls import media_url_cache
+
+logger = logging.getLogger(__name__)
+
+
+def render_variants(data, sizes):
+    # runs in a worker process: decode once, scale down to every size
+    variants = {}
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        for variant, size in sizes.items():
+            scaled = image.copy()
+            scaled.thumbnail(size)
+            if scaled.mode in ("RGBA", "LA") or "transparency" in scaled.info:
+                image_format, extension = "PNG", "png"
+            else:
+                image_format, extension = "JPEG", "jpg"
+                scaled = scaled.convert("RGB")
+            out = BytesIO()
+            scaled.save(out, image_format, optimize=True)
+            variants[variant] = (out.getvalue(), extension)
+    return variants
+
+
+def is_image(name):
+    content_type, _ = mimetypes.guess_type(name)
+    return bool(content_type) and content_type.startswith("image/")
+
+
+def get_variant_name(upload, variant, extension):
+    # under the upload's own prefix, never next to someone else's file
+    root, _ = os.path.splitext(os.path.basename(upload.file_upload.name))
+    return f"variants/{upload.pk}/{root}_{variant}.{extension}"
+
+
+# resizes images in a process pool, the storage and database work around it
+# happens on a few threads so requests never wait for either
+class ThumbnailGenerator:
+
+    def __init__(self, sizes=None, processes=None):
+        self.sizes = sizes or getattr(settings, "THUMBNAIL_SIZES", {
+            "thumbnail": (128, 128), "preview": (640, 640)})
+        self.processes = processes if processes is not None else getattr(
+            settings, "THUMBNAIL_PROCESSES", 2)
+        self._pool = None
+        self._threads = None
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.processes)
+                self._threads = ThreadPoolExecutor(
+                    self.processes, thread_name_prefix="thumbnails")
+            return self._pool
+
+    def render(self, data):
+        if not self.processes:
+            return render_variants(data, self.sizes)
+        return self.get_pool().submit(render_variants, data, self.sizes).result()
+
+    def submit(self, upload_id):
+        # after commit, so the worker sees the row
+        transaction.on_commit(lambda: self._submit(upload_id))
+
+    def _submit(self, upload_id):
+        if not self.processes:
+            self._run(upload_id)
+            return
+        self.get_pool()
+        self._threads.submit(self._run_in_thread, upload_id)
+
+    def _run(self, upload_id, force=False):
+        try:
+            return self.generate(upload_id, force)
+        except Exception:
+            logger.exception("could not generate thumbnails of upload %s", upload_id)
+            return None
+
+    def _run_in_thread(self, upload_id, force=False):
+        try:
+            return self._run(upload_id, force)
+        finally:
+            close_old_connections()
+
+    def generate_many(self, upload_ids, force=False):
+        # keeps every worker process busy, returns how many got variants
+        if not self.processes:
+            results = [self._run(upload_id, force) for upload_id in upload_ids]
+        else:
+            with ThreadPoolExecutor(self.processes) as threads:
+                results = list(threads.map(
+                    lambda upload_id: self._run_in_thread(upload_id, force), upload_ids))
+        return sum(1 for variants in results if variants)
+
+    def generate(self, upload_id, force=False):
+        from .models import GenericFileUpload
+
+        upload = GenericFileUpload.objects.filter(id=upload_id).first()
+        if upload is None or not is_image(upload.file_upload.name):
+            return None
+        if upload.variants and not force:
+            return upload.variants
+
+        with upload.file_upload.open("rb") as original:
+            data = original.read()
+        variants = self.save(upload, self.render(data))
+        GenericFileUpload.objects.filter(id=upload.id).update(variants=variants)
+        # files of an earlier generation that were not reused
+        storage = upload.file_upload.storage
+        stale = [name for name in upload.variants.values()
+                 if name not in variants.values()]
+        for name in stale:
+            storage.delete(name)
+        media_url_cache.discard(stale)
+        GenericFileUpload.bump_referrers([upload.id])
+        return variants
+
+    def save(self, upload, rendered):
+        # generating again replaces the files this upload recorded, any
+        # other name the storage already holds is left alone
+        storage = upload.file_upload.storage
+        variants = {}
+        for variant, (content, extension) in rendered.items():
+            name = get_variant_name(upload, variant, extension)
+            if upload.variants.get(variant) == name and storage.exists(name):
+                storage.delete(name)
+            variants[variant] = storage.save(name, ContentFile(content))
+        return variants
+
+
+thumbnail_generator = ThumbnailGenerator()
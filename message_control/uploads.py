@@ -0,0 +1,205 @@
+import hashlib
+import os
+import tempfile
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db import IntegrityError, transaction
+from storages.backends.s3boto3 import S3Boto3Storage
+
+BLOCK_SIZE = 64 * 1024
+
+
+# multipart uploads are hashed chunk by chunk while django receives them,
+# the finished file carries the hex digest
+class DigestMixin:
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        passed_on = super().receive_data_chunk(raw_data, start)
+        if passed_on is None:
+            # only the handler that keeps the chunk hashes it
+            self.sha256.update(raw_data)
+        return passed_on
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.digest = self.sha256.hexdigest()
+        return file
+
+
+class DigestMemoryFileUploadHandler(DigestMixin, MemoryFileUploadHandler):
+    pass
+
+
+class DigestTemporaryFileUploadHandler(DigestMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def get_digest(file):
+    digest = getattr(file, "digest", None)
+    if digest:
+        return digest
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks(BLOCK_SIZE):
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
+
+
+def store_upload(digest, save):
+    # returns the upload holding this content, calling save(upload) to write
+    # it to the storage only when there is none yet
+    from .models import GenericFileUpload
+
+    existing = GenericFileUpload.objects.filter(digest=digest).first() if digest else None
+    if existing is not None:
+        return existing, False
+
+    upload = GenericFileUpload(digest=digest)
+    save(upload)
+    try:
+        with transaction.atomic():
+            upload.save()
+    except IntegrityError:
+        # the same content was stored concurrently, keep that copy
+        upload.file_upload.storage.delete(upload.file_upload.name)
+        return GenericFileUpload.objects.get(digest=digest), False
+    return upload, True
+
+
+class ChunkError(ValueError):
+    pass
+
+
+def copy_stream(stream, target, limit):
+    # copies the request body in small blocks; reading one byte past limit
+    # is how an oversized chunk is noticed
+    copied = 0
+    while copied <= limit:
+        block = stream.read(min(BLOCK_SIZE, limit + 1 - copied))
+        if not block:
+            break
+        target.write(block)
+        copied += len(block)
+    if copied > limit:
+        raise ChunkError(f"Chunk is larger than {limit} bytes.")
+    return copied
+
+
+# chunks are written in place into a temporary file, which is handed to the
+# storage once complete; the storage copies it in blocks as well
+class LocalChunkStore:
+
+    def __init__(self, directory=None):
+        self.directory = directory or getattr(
+            settings, "CHUNKED_UPLOAD_DIR",
+            os.path.join(tempfile.gettempdir(), "chatapi-uploads"))
+
+    def get_path(self, upload):
+        return os.path.join(self.directory, f"{upload.id}.part")
+
+    def start(self, upload, storage):
+        os.makedirs(self.directory, exist_ok=True)
+        open(self.get_path(upload), "wb").close()
+
+    def append(self, upload, storage, stream, limit):
+        # writing at the offset makes a retried chunk overwrite itself
+        with open(self.get_path(upload), "r+b") as target:
+            target.seek(upload.offset)
+            return copy_stream(stream, target, limit)
+
+    def get_digest(self, upload):
+        path = self.get_path(upload)
+        with open(path, "r+b") as source:
+            # drop whatever an interrupted chunk left past the end
+            source.truncate(upload.size)
+            return get_digest(File(source))
+
+    def complete(self, upload, storage):
+        path = self.get_path(upload)
+        with open(path, "rb") as source:
+            name = storage.save(upload.filename, File(source, name=upload.filename))
+        os.remove(path)
+        return name
+
+    def abort(self, upload, storage):
+        try:
+            os.remove(self.get_path(upload))
+        except FileNotFoundError:
+            pass
+
+
+def get_backend(storage):
+    # the S3 storage itself, also when it sits behind the local media cache
+    return getattr(storage, "backend", storage)
+
+
+# every chunk becomes a part of an S3 multipart upload, so nothing but the
+# chunk in flight is ever held by the worker
+class S3ChunkStore:
+    # S3 rejects smaller parts, except for the last one
+    min_part_size = 5 * 1024 * 1024
+    spool_size = 1024 * 1024
+
+    def get_key(self, upload, storage):
+        storage = get_backend(storage)
+        return storage._normalize_name(storage._clean_name(upload.name))
+
+    def start(self, upload, storage):
+        storage = get_backend(storage)
+        upload.name = storage.get_available_name(upload.filename)
+        key = self.get_key(upload, storage)
+        params = storage._get_write_parameters(key)
+        response = storage.bucket.meta.client.create_multipart_upload(
+            Bucket=storage.bucket.name, Key=key, **params)
+        upload.upload_id = response["UploadId"]
+
+    def append(self, upload, storage, stream, limit):
+        storage = get_backend(storage)
+        with tempfile.SpooledTemporaryFile(self.spool_size) as part:
+            written = copy_stream(stream, part, limit)
+            if written < self.min_part_size and upload.offset + written < upload.size:
+                raise ChunkError(
+                    f"Chunks must be at least {self.min_part_size} bytes, "
+                    "except for the last one.")
+            part.seek(0)
+
+            number = len(upload.parts) + 1
+            response = storage.bucket.meta.client.upload_part(
+                Bucket=storage.bucket.name, Key=self.get_key(upload, storage),
+                UploadId=upload.upload_id, PartNumber=number,
+                Body=part, ContentLength=written)
+
+        upload.parts = upload.parts + [
+            {"PartNumber": number, "ETag": response["ETag"]}]
+        return written
+
+    def get_digest(self, upload):
+        # the parts are already in S3, hashing would mean downloading them
+        return None
+
+    def complete(self, upload, storage):
+        storage = get_backend(storage)
+        storage.bucket.meta.client.complete_multipart_upload(
+            Bucket=storage.bucket.name, Key=self.get_key(upload, storage),
+            UploadId=upload.upload_id, MultipartUpload={"Parts": upload.parts})
+        return upload.name
+
+    def abort(self, upload, storage):
+        storage = get_backend(storage)
+        if upload.upload_id:
+            storage.bucket.meta.client.abort_multipart_upload(
+                Bucket=storage.bucket.name, Key=self.get_key(upload, storage),
+                UploadId=upload.upload_id)
+
+
+def get_chunk_store(storage):
+    # parts go straight to S3 behind the local media cache as well
+    if isinstance(get_backend(storage), S3Boto3Storage):
+        return S3ChunkStore()
+    return LocalChunkStore()
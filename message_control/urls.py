@@ -1,5 +1,5 @@
 from rest_framework.routers import DefaultRouter
-from .views import GenericFileUploadView, MessageView, ReadMultipleMessages
+from .views import AttachmentDownloadView, ChunkedUploadView, ChunkedUploadDetailView, ChunkedUploadCompleteView, GenericFileUploadView, MessageView, ReadMultipleMessages, MessageSearchView, MessageSyncView, SendMultipleMessages, ReadConversation, UnreadCountView, InboxView
 from django.urls import path, include
 
 router = DefaultRouter(trailing_slash=False)
@@ -11,5 +11,17 @@ router.register("message", MessageView)
 urlpatterns = [
     path("", include(router.urls)),
     path("read-messages", ReadMultipleMessages.as_view()),
+    path("read-conversation", ReadConversation.as_view()),
+    path("send-messages", SendMultipleMessages.as_view()),
+    path("unread-count", UnreadCountView.as_view()),
+    path("search", MessageSearchView.as_view()),
+    path("inbox", InboxView.as_view()),
+    path("sync", MessageSyncView.as_view()),
+    path("chunked-upload", ChunkedUploadView.as_view()),
+    path("chunked-upload/<uuid:upload_id>", ChunkedUploadDetailView.as_view()),
+    path("chunked-upload/<uuid:upload_id>/complete",
+         ChunkedUploadCompleteView.as_view()),
+    path("attachment/<int:attachment_id>/download",
+         AttachmentDownloadView.as_view()),
 
 ]
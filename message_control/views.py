@@ -1,33 +1,51 @@
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.views import APIView
-from django.db.models import Q
-from .serializers import GenericFileUploadSerializer, MessageSerializer
-from .models import GenericFileUpload, Message, MessageAttachment
+from rest_framework.generics import ListAPIView
+from rest_framework.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q, F, Max, OuterRef, Subquery, Value, FloatField, CharField
+from django.utils import timezone
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_date, parse_datetime
+from .serializers import ChunkedUploadSerializer, ConversationSerializer, GenericFileUploadSerializer, MessageSerializer, MessageSearchSerializer, MessageSyncSerializer
+from .models import ChunkedUpload, Conversation, GenericFileUpload, Message, MessageAttachment, ReadCursor, UnreadCounter, UnreadTotal
+from .pagination import ConversationPagination, MessagePagination
 from rest_framework.response import Response
 # from rest_framework.permissions import IsAuthenticated
+from chatapi.conditional import conditional, make_etag
 from chatapi.custom_auth_permission import IsAuthenticatedCustom
+from user_control.models import UserProfile
 from django.conf import settings
-import requests
-import json
+from .notifications import notification_dispatcher
+from .realtime import subscriptions
+from .search import message_index, index_messages
+from .downloads import serve_upload
+from .uploads import ChunkError, get_chunk_store, get_digest, store_upload
+from django.shortcuts import get_object_or_404
+import io
+from datetime import timedelta
 
 
-def handleRequest(serializerData):
-    notification = {
-        "message": serializerData.data.get("message"),
-        "from": serializerData.data.get("sender"),
-        "receiver": serializerData.data.get("receiver").get("id")
+def get_notification(message_data):
+    return {
+        "message": message_data.get("message"),
+        "from": message_data.get("sender"),
+        "receiver": message_data.get("receiver").get("id")
     }
 
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    try:
-        t = requests.post(settings.SOCKET_SERVER, json.dumps(
-            notification), headers=headers)
-        print(t)
 
-    except Exception as e:
-        pass
+def notify(notifications):
+    # notifications are (receiver user id, payload) pairs; only those the
+    # registry could not hand over go to the external socket server
+    remaining = [notification for receiver_id, notification in notifications
+                 if not subscriptions.publish(receiver_id, notification)]
+    if remaining and settings.SOCKET_SERVER:
+        notification_dispatcher.submit_many(remaining)
+
+
+def handleRequest(serializerData):
+    notify([(serializerData.instance.receiver_id,
+             get_notification(serializerData.data))])
     return True
 
 
@@ -35,12 +53,134 @@ class GenericFileUploadView(ModelViewSet):
     queryset = GenericFileUpload.objects.all()
     serializer_class = GenericFileUploadSerializer
 
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # content that is already stored is answered with the existing upload
+        file = serializer.validated_data["file_upload"]
+        upload, _ = store_upload(
+            get_digest(file), lambda upload: upload.file_upload.save(file.name, file, save=False))
+        return Response(self.get_serializer(upload).data, status=201)
+
+
+def get_upload_storage():
+    return GenericFileUpload._meta.get_field("file_upload").storage
+
+
+class ChunkedUploadView(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def post(self, request):
+        serializer = ChunkedUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        storage = get_upload_storage()
+        upload = ChunkedUpload(user_id=request.user.id, **serializer.validated_data)
+        get_chunk_store(storage).start(upload, storage)
+        upload.save()
+        return Response(ChunkedUploadSerializer(upload).data, status=201)
+
+
+class ChunkedUploadDetailView(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def get_object(self, upload_id):
+        return get_object_or_404(
+            ChunkedUpload, id=upload_id, user_id=self.request.user.id)
+
+    def get(self, request, upload_id):
+        # where an interrupted upload resumes
+        return Response(ChunkedUploadSerializer(self.get_object(upload_id)).data)
+
+    def put(self, request, upload_id):
+        upload = self.get_object(upload_id)
+        if upload.file_upload_id:
+            raise ValidationError({"upload": "Upload is already complete."})
+
+        offset = request.query_params.get("offset", "")
+        if not offset.isdigit():
+            raise ValidationError({"offset": "A numeric offset is required."})
+        if int(offset) != upload.offset:
+            return Response({"offset": upload.offset}, status=409)
+
+        storage = get_upload_storage()
+        limit = min(getattr(settings, "CHUNKED_UPLOAD_MAX_CHUNK_SIZE", 8 * 1024 ** 2),
+                    upload.size - upload.offset)
+        # the body is read from the stream in blocks, never as a whole
+        stream = request.stream or io.BytesIO()
+        try:
+            written = get_chunk_store(storage).append(upload, storage, stream, limit)
+        except ChunkError as e:
+            raise ValidationError({"chunk": str(e)})
+
+        # a concurrent request for the same offset only counts once
+        if not ChunkedUpload.objects.filter(id=upload.id, offset=upload.offset).update(
+                offset=upload.offset + written, parts=upload.parts, updated_at=timezone.now()):
+            upload.refresh_from_db()
+            return Response({"offset": upload.offset}, status=409)
+
+        upload.offset += written
+        return Response(ChunkedUploadSerializer(upload).data)
+
+    def delete(self, request, upload_id):
+        upload = self.get_object(upload_id)
+        if not upload.file_upload_id:
+            storage = get_upload_storage()
+            get_chunk_store(storage).abort(upload, storage)
+        upload.delete()
+        return Response(status=204)
+
+
+class ChunkedUploadCompleteView(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def post(self, request, upload_id):
+        upload = get_object_or_404(
+            ChunkedUpload, id=upload_id, user_id=request.user.id)
+        if not upload.file_upload_id:
+            if upload.offset != upload.size:
+                raise ValidationError({"offset": f"Only {upload.offset} of {upload.size} bytes were received."})
+
+            storage = get_upload_storage()
+            store = get_chunk_store(storage)
+
+            def save(file_upload):
+                file_upload.file_upload.name = store.complete(upload, storage)
+
+            upload.file_upload, created = store_upload(store.get_digest(upload), save)
+            if not created:
+                store.abort(upload, storage)
+            upload.save(update_fields=["file_upload", "updated_at"])
+
+        return Response(GenericFileUploadSerializer(upload.file_upload).data, status=201)
+
+
+class AttachmentDownloadView(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def get(self, request, attachment_id):
+        # only the two people in the conversation may fetch it
+        attachment = get_object_or_404(
+            MessageAttachment.objects.select_related("attachment"),
+            Q(message__sender_id=request.user.id) | Q(
+                message__receiver_id=request.user.id),
+            id=attachment_id)
+        return serve_upload(request, attachment.attachment)
+
 
 class MessageView(ModelViewSet):
     queryset = Message.objects.select_related(
-        "sender", "receiver").prefetch_related("message_attachments")
+        "sender__user_profile__profile_picture",
+        "receiver__user_profile__profile_picture",
+    ).prefetch_related(
+        "message_attachments__attachment",
+        "sender__groups", "sender__user_permissions",
+        "receiver__groups", "receiver__user_permissions",
+    )
     serializer_class = MessageSerializer
     permission_classes = (IsAuthenticatedCustom, )
+    pagination_class = MessagePagination
 
     def get_queryset(self):
         data = self.request.query_params.dict()
@@ -48,10 +188,36 @@ class MessageView(ModelViewSet):
 
         if user_id:
             active_user_id = self.request.user.id
-            return self.queryset.filter(Q(sender_id=user_id, receiver_id=active_user_id) | Q(
-                sender_id=active_user_id, receiver_id=user_id)).distinct()
+            return self.queryset.filter(
+                conversation_key=Message.get_conversation_key(user_id, active_user_id))
         return self.queryset
 
+    def list(self, request, *args, **kwargs):
+        return conditional(request, self.get_list_etag(request),
+                           lambda: super(MessageView, self).list(request, *args, **kwargs))
+
+    def get_list_etag(self, request):
+        # a thread is versioned by its conversation and the two profiles
+        # embedded in it, read in one query along with the presence of both
+        # users, which is written apart from any version; unread counts
+        # depend on the viewer and the page on the query string
+        user_id = request.query_params.get("user_id", None)
+        if not user_id or not user_id.isdigit():
+            return None
+        key = Message.get_conversation_key(user_id, request.user.id)
+
+        def profile_version(field):
+            return Subquery(UserProfile.objects.filter(
+                user_id=OuterRef(field)).values("version")[:1])
+
+        versions = Conversation.objects.filter(key=key).annotate(
+            low_version=profile_version("user_low_id"),
+            high_version=profile_version("user_high_id"),
+        ).values_list("version", "low_version", "high_version",
+                      "user_low__is_online", "user_high__is_online").first()
+        return make_etag("messages", request.user.id, key, versions,
+                         sorted(request.query_params.items()))
+
     def create(self, request, *args, **kwargs):
         try:
             request.data._mutable = True
@@ -62,16 +228,19 @@ class MessageView(ModelViewSet):
         if str(request.user.id) != str(request.data.get("sender_id", None)):
             raise Exception("only sender can create a message")
 
-        attachments = request.data.pop('attachments', None)
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        # the unread counters are bumped by the save signal, in this
+        # transaction
+        with transaction.atomic():
+            serializer.save()
+            if attachments:
+                self.add_attachments(serializer.instance.id, attachments)
 
         if attachments:
-            MessageAttachment.objects.bulk_create([MessageAttachment(
-                **attachment, message_id=serializer.data["id"]) for attachment in attachments])
-            message_data = self.get_queryset().get(id=serializer.data["id"])
-            return Response(self.serializer_class(message_data).data, status=201)
+            # read again so the payload shows the attachments
+            serializer = self.serializer_class(
+                self.get_queryset().get(id=serializer.instance.id))
 
         handleRequest(serializer)
 
@@ -88,26 +257,317 @@ class MessageView(ModelViewSet):
         serializer = self.serializer_class(
             data=request.data, instance=instance, partial=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with transaction.atomic():
+            serializer.save()
 
-        MessageAttachment.objects.filter(message_id=instance.id).delete()
+            # referenced again before the old ones are released, so uploads
+            # kept by the edit are never deleted
+            previous = list(MessageAttachment.objects.filter(
+                message_id=instance.id).values_list("id", flat=True))
+            if attachments:
+                self.add_attachments(instance.id, attachments)
+            MessageAttachment.objects.filter(id__in=previous).delete()
 
         if attachments:
-            MessageAttachment.objects.bulk_create([MessageAttachment(
-                **attachment, message_id=instance.id) for attachment in attachments])
-
-            message_data = self.get_object()
-            return Response(self.serializer_class(message_data).data, status=200)
+            serializer = self.serializer_class(self.get_object())
 
         handleRequest(serializer)
 
         return Response(serializer.data, status=200)
 
+    @staticmethod
+    def add_attachments(message_id, attachments):
+        MessageAttachment.objects.bulk_create([MessageAttachment(
+            **attachment, message_id=message_id) for attachment in attachments])
+        # bulk_create sends no post_save
+        GenericFileUpload.add_references(
+            [attachment["attachment_id"] for attachment in attachments])
+
+
+class SendMultipleMessages(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def post(self, request):
+        items = self.get_items(request.data)
+        if not items:
+            raise ValidationError(
+                {"messages": "Provide receiver_ids or messages."})
+
+        serializer = MessageSerializer(data=items, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.validate_references(items)
+
+        with transaction.atomic():
+            messages = self.create_messages(items)
+
+        index_messages(messages)
+
+        queryset = MessageView.queryset.filter(
+            id__in=[message.id for message in messages]).order_by("id")
+        data = MessageSerializer(
+            queryset, many=True, context={"request": request}).data
+
+        notify([(message["receiver"]["user"]["id"], get_notification(message))
+                for message in data])
+
+        return Response(data, status=201)
+
+    def get_items(self, data):
+        sender_id = self.request.user.id
+        messages = data.get("messages", None)
+        if messages is None:
+            # one body and its attachments for every receiver
+            messages = [{
+                "receiver_id": receiver_id,
+                "message": data.get("message", None),
+                "attachments": data.get("attachments", None),
+            } for receiver_id in data.get("receiver_ids", None) or []]
+
+        return [{**message, "sender_id": sender_id} for message in messages]
+
+    @staticmethod
+    def validate_references(items):
+        from user_control.models import CustomUser
+
+        receiver_ids = {int(item["receiver_id"]) for item in items}
+        if CustomUser.objects.filter(id__in=receiver_ids).count() != len(receiver_ids):
+            raise ValidationError({"receiver_id": "Unknown receiver."})
+
+        attachment_ids = {int(attachment["attachment_id"]) for item in items
+                          for attachment in item.get("attachments", None) or []}
+        if GenericFileUpload.objects.filter(id__in=attachment_ids).count() != len(attachment_ids):
+            raise ValidationError({"attachment_id": "Unknown attachment."})
+
+    @staticmethod
+    def create_messages(items):
+        messages = [Message(
+            sender_id=item["sender_id"],
+            receiver_id=int(item["receiver_id"]),
+            message=item.get("message", None),
+            conversation_key=Message.get_conversation_key(
+                item["sender_id"], item["receiver_id"]),
+        ) for item in items]
+        Message.objects.bulk_create(messages)
+
+        if messages[0].pk is None:
+            # the backend returns no ids from a bulk insert; every row is
+            # found again by receiver and creation time, which bulk_create
+            # set on the instances, and rows sharing both are ours newest first
+            rows = Message.objects.filter(
+                sender_id=messages[0].sender_id,
+                receiver_id__in={message.receiver_id for message in messages},
+                created_at__in={message.created_at for message in messages},
+            ).order_by("id").values_list("receiver_id", "created_at", "id")
+            ids = {}
+            for receiver_id, created_at, message_id in rows:
+                ids.setdefault((receiver_id, created_at), []).append(message_id)
+            for message in reversed(messages):
+                message.pk = ids[(message.receiver_id, message.created_at)].pop()
+
+        # bulk_create sends no post_save
+        Conversation.record(messages)
+        UnreadCounter.increment(
+            [(message.receiver_id, message.sender_id) for message in messages])
+
+        attachments = [
+            MessageAttachment(**attachment, message_id=message.id)
+            for message, item in zip(messages, items)
+            for attachment in item.get("attachments", None) or []
+        ]
+        MessageAttachment.objects.bulk_create(attachments)
+        GenericFileUpload.add_references(
+            [attachment.attachment_id for attachment in attachments])
+        return messages
+
 
 class ReadMultipleMessages(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
 
     def post(self, request):
         data = request.data.get("message_ids", None)
 
-        Message.objects.filter(id__in=data).update(is_read=True)
+        # the newest listed message from each sender becomes the read
+        # cursor of that conversation
+        latest = Message.objects.filter(
+            id__in=data or [], receiver_id=request.user.id
+        ).order_by().values("sender_id").annotate(read_at=Max("created_at"))
+        for row in latest:
+            with transaction.atomic():
+                ReadCursor.advance(
+                    request.user.id, row["sender_id"], row["read_at"])
+                UnreadCounter.refresh(request.user.id, row["sender_id"])
         return Response("success")
+
+
+class ReadConversation(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def post(self, request):
+        from user_control.models import CustomUser
+
+        user_id = request.data.get("user_id", None)
+        if not user_id:
+            return Response({"error": "user_id is required"}, status="400")
+        if not str(user_id).isdigit():
+            return Response({"error": "user_id must be a number"}, status="400")
+        peer = get_object_or_404(CustomUser, pk=user_id)
+
+        read_at = timezone.now()
+        with transaction.atomic():
+            ReadCursor.advance(request.user.id, peer.id, read_at)
+            UnreadCounter.refresh(request.user.id, peer.id)
+        return Response({"last_read_at": read_at})
+
+
+class MessageSyncView(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def get(self, request):
+        user_id = request.user.id
+        # changes are handed out once they are SYNC_SETTLE_TIME old, so a
+        # transaction committing after a later one is never skipped
+        upto = timezone.now() - timedelta(
+            seconds=getattr(settings, "SYNC_SETTLE_TIME", 2))
+
+        since = request.query_params.get("since", None)
+        if not since:
+            # a new client loads history from the message list, changes
+            # start from now
+            return Response({"messages": [], "reads": [],
+                             "watermark": upto, "has_more": False})
+        try:
+            since = parse_datetime(since)
+        except ValueError:
+            since = None
+        if since is None:
+            raise ValidationError({"since": "Invalid watermark."})
+
+        # an empty poll ends with this one query
+        limit = getattr(settings, "SYNC_PAGE_SIZE", 200)
+        changes = list(self.get_changes(user_id, since, upto)[:limit])
+        has_more = len(changes) == limit
+        if has_more:
+            # the rest of the last instant, the watermark never splits it
+            last = changes[-1][0]
+            seen = set(changes)
+            changes.extend(change for change in self.get_changes(
+                user_id, last - timedelta(microseconds=1), last) if change not in seen)
+
+        message_ids = [id for _, id, kind in changes if kind == "message"]
+        read_ids = [id for _, id, kind in changes if kind == "read"]
+        messages = Message.objects.prefetch_related(
+            "message_attachments__attachment"
+        ).filter(id__in=message_ids).order_by("updated_at", "id") if message_ids else []
+        reads = ReadCursor.objects.filter(id__in=read_ids).order_by(
+            "updated_at").values("user_id", "peer_id", "last_read_at") if read_ids else []
+
+        return Response({
+            "messages": MessageSyncSerializer(
+                messages, many=True, context={"request": request}).data,
+            "reads": list(reads),
+            "watermark": changes[-1][0] if has_more else upto,
+            "has_more": has_more,
+        })
+
+    @staticmethod
+    def get_changes(user_id, since, upto):
+        # (updated_at, id, kind) of the messages sent or received and the
+        # read cursors moved by or for the user within the window
+        window = {"updated_at__gt": since, "updated_at__lte": upto}
+        messages = Message.objects.filter(
+            Q(sender_id=user_id, **window) | Q(receiver_id=user_id, **window)
+        ).order_by().annotate(
+            kind=Value("message", CharField())).values_list("updated_at", "id", "kind")
+        reads = ReadCursor.objects.filter(
+            Q(user_id=user_id, **window) | Q(peer_id=user_id, **window)
+        ).order_by().annotate(
+            kind=Value("read", CharField())).values_list("updated_at", "id", "kind")
+        return messages.union(reads, all=True).order_by("updated_at")
+
+
+class UnreadCountView(APIView):
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def get(self, request):
+        user_id = request.query_params.get("user_id", None)
+        if user_id:
+            if not user_id.isdigit():
+                raise ValidationError({"user_id": "Invalid user id."})
+            user_id = int(user_id)
+            count = UnreadCounter.counts(
+                request.user.id, [user_id]).get(user_id, 0)
+            return Response({"user_id": user_id, "unread_count": count})
+        return Response({"unread_count": UnreadTotal.get(request.user.id)})
+
+
+class InboxView(ListAPIView):
+    queryset = Conversation.objects.select_related(
+        "user_low__user_profile__profile_picture",
+        "user_high__user_profile__profile_picture",
+    )
+    serializer_class = ConversationSerializer
+    permission_classes = (IsAuthenticatedCustom, )
+    pagination_class = ConversationPagination
+
+    def get_queryset(self):
+        user_id = self.request.user.id
+        return self.queryset.filter(
+            Q(user_low_id=user_id) | Q(user_high_id=user_id))
+
+
+class MessageSearchView(ListAPIView):
+    serializer_class = MessageSearchSerializer
+    permission_classes = (IsAuthenticatedCustom, )
+
+    def get_queryset(self):
+        from user_control.views import UserProfileView
+
+        data = self.request.query_params
+        terms = UserProfileView.normalize_query(data.get("q", ""))
+        if not terms:
+            raise ValidationError({"q": "This field is required."})
+
+        active_user_id = self.request.user.id
+        user_id = data.get("user_id", None)
+        if user_id:
+            queryset = MessageView.queryset.filter(
+                conversation_key=Message.get_conversation_key(user_id, active_user_id))
+        else:
+            queryset = MessageView.queryset.filter(
+                Q(sender_id=active_user_id) | Q(receiver_id=active_user_id))
+
+        since = self.parse_date(data.get("since", None))
+        if since:
+            queryset = queryset.filter(created_at__gte=since)
+        until = self.parse_date(data.get("until", None))
+        if until:
+            queryset = queryset.filter(created_at__lt=until)
+
+        if not message_index.can_search(terms):
+            for term in terms:
+                queryset = queryset.filter(message__icontains=term)
+            return queryset.annotate(
+                rank=Value(None, output_field=FloatField()),
+                snippet=F("message"))
+
+        match = message_index.match_query(terms)
+        rowid = f'"{Message._meta.db_table}"."id"'
+        return queryset.filter(
+            id__in=RawSQL(message_index.rowids_sql(), [match])
+        ).annotate(
+            rank=RawSQL(message_index.rank_sql(rowid), [match]),
+            snippet=RawSQL(message_index.snippet_sql(rowid), [match],
+                           output_field=CharField()),
+        ).order_by("rank", "-created_at")
+
+    @staticmethod
+    def parse_date(value):
+        if not value:
+            return None
+        try:
+            parsed = parse_datetime(value) or parse_date(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValidationError({"date": f"Invalid date {value}"})
+        return parsed
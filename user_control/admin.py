@@ -1,4 +1,4 @@
 from django.contrib import admin
-from .models import CustomUser, Jwt, Favorite, UserProfile
+from .models import CustomUser, Jwt, Favorite, UserProfile, RevokedToken
 
-admin.site.register((CustomUser, UserProfile, Favorite, Jwt))
+admin.site.register((CustomUser, UserProfile, Favorite, Jwt, RevokedToken))
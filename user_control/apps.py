@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class UserControlConfig(AppConfig):
     name = 'user_control'
+
+    def ready(self):
+        from . import signals  # noqa: F401
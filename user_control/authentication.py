@@ -3,16 +3,26 @@ from django.conf import settings
 from datetime import datetime
 from rest_framework.authentication import BaseAuthentication
 from .models import CustomUser, Jwt
+from .cache import principal_cache
+from .revocation import token_denylist
 
 
 class Authentication(BaseAuthentication):
 
     def authenticate(self, request):
+        token = request.headers.get("Authorization", "")[7:]
+        user = principal_cache.get(token) if token else None
+        if user:
+            return user, None
+
         data = self.validate_request(request.headers)
         if not data:
             return None, None
 
-        return self.get_user(data["user_id"]), None
+        user = self.get_user(data["user_id"])
+        if user:
+            principal_cache.set(token, user, data["exp"], data.get("jti"))
+        return user, None
 
     def get_user(self, user_id):
         try:
@@ -48,4 +58,8 @@ class Authentication(BaseAuthentication):
         if datetime.now().timestamp() > exp:
             return None
 
+        # revoked on logout before it expired
+        if token_denylist.is_revoked(decoded_data.get("jti")):
+            return None
+
         return decoded_data
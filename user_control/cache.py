@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from django.conf import settings
+from .revocation import token_denylist
+
+
+# bounded LRU cache of authenticated users keyed by their verified access
+# token, entries never outlive the token's exp claim
+class PrincipalCache:
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or getattr(
+            settings, "PRINCIPAL_CACHE_SIZE", 1024)
+        self.ttl = ttl or getattr(settings, "PRINCIPAL_CACHE_TTL", 300)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tokens_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        now = datetime.now().timestamp()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry["expires"] <= now:
+                self._remove(token)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+        # checked outside the lock, the denylist may sync from the database
+        revoked = token_denylist.is_revoked(entry["jti"])
+        with self._lock:
+            if revoked:
+                self._remove(token)
+                self.misses += 1
+                return None
+            if token in self._entries:
+                self._entries.move_to_end(token)
+            self.hits += 1
+
+        # hand out a fresh instance so related-object caches set by one
+        # request never leak into another
+        user_model = entry["model"]
+        return user_model.from_db(entry["db"], entry["fields"], entry["values"])
+
+    def set(self, token, user, exp, jti=None):
+        if not user.is_active:
+            return
+        expires = min(datetime.now().timestamp() + self.ttl, exp)
+        fields = tuple(f.attname for f in user._meta.concrete_fields)
+        entry = {
+            "model": type(user),
+            "db": user._state.db,
+            "fields": fields,
+            "values": tuple(getattr(user, f) for f in fields),
+            "user_id": user.pk,
+            "jti": jti,
+            "expires": expires,
+        }
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = entry
+            self._tokens_by_user.setdefault(user.pk, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _remove(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry["user_id"])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry["user_id"]]
+
+
+principal_cache = PrincipalCache()
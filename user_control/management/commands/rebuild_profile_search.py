@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from user_control.search import profile_index, rebuild_profile_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text index used by the profile keyword search."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not profile_index.is_available():
+            raise CommandError(
+                "Profile full-text search is only available on SQLite.")
+
+        total = rebuild_profile_index(options["chunk_size"])
+        self.stdout.write(f"indexed {total} profiles")
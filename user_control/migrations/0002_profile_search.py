@@ -0,0 +1,43 @@
+from django.db import migrations
+from chatapi.fts import FullTextIndex
+
+profile_index = FullTextIndex(
+    'user_control_profile_search',
+    ('username', 'first_name', 'last_name', 'email'))
+
+
+def create_profile_index(apps, schema_editor):
+    if not profile_index.is_available(schema_editor.connection):
+        return
+    profile_index.create(schema_editor.connection)
+
+    UserProfile = apps.get_model('user_control', 'UserProfile')
+    last_id = 0
+    while True:
+        chunk = list(UserProfile.objects.select_related('user').filter(
+            id__gt=last_id).order_by('id')[:1000])
+        if not chunk:
+            break
+        profile_index.upsert_many([(profile.id, {
+            'username': profile.user.username,
+            'first_name': profile.first_name,
+            'last_name': profile.last_name,
+            'email': profile.user.email,
+        }) for profile in chunk], schema_editor.connection)
+        last_id = chunk[-1].id
+
+
+def drop_profile_index(apps, schema_editor):
+    if profile_index.is_available(schema_editor.connection):
+        profile_index.drop(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_control', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_profile_index, drop_profile_index),
+    ]
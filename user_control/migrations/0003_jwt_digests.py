@@ -0,0 +1,55 @@
+import hashlib
+from django.db import migrations, models
+
+
+def backfill_digests(apps, schema_editor):
+    Jwt = apps.get_model('user_control', 'Jwt')
+    last_id = 0
+    while True:
+        chunk = list(Jwt.objects.filter(id__gt=last_id).order_by('id')[:1000])
+        if not chunk:
+            break
+        for session in chunk:
+            session.access_digest = hashlib.sha256(session.access.encode()).hexdigest()
+            session.refresh_digest = hashlib.sha256(session.refresh.encode()).hexdigest()
+        Jwt.objects.bulk_update(chunk, ['access_digest', 'refresh_digest'])
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_control', '0002_profile_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jwt',
+            name='access_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='jwt',
+            name='refresh_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_digests, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='jwt',
+            name='access',
+        ),
+        migrations.RemoveField(
+            model_name='jwt',
+            name='refresh',
+        ),
+        migrations.AlterField(
+            model_name='jwt',
+            name='access_digest',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='jwt',
+            name='refresh_digest',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
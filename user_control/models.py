@@ -1,3 +1,4 @@
+import hashlib
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from message_control.models import GenericFileUpload
@@ -60,6 +61,9 @@ class UserProfile(models.Model):
         GenericFileUpload, related_name="user_image", on_delete=models.SET_NULL, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # bumped by every change to the profile or its user, the profile's
+    # ETag is derived from it
+    version = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.user.username
@@ -67,6 +71,18 @@ class UserProfile(models.Model):
     class Meta:
         ordering = ("created_at",)
 
+    def save(self, *args, **kwargs):
+        # moved in the database only, an instance never writes back a
+        # version it read earlier
+        if self.pk is not None:
+            self.version = models.F("version") + 1
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def bump(cls, user_ids):
+        cls.objects.filter(user_id__in=user_ids).update(
+            version=models.F("version") + 1)
+
 
 class Favorite(models.Model):
     user = models.OneToOneField(
@@ -84,7 +100,21 @@ class Favorite(models.Model):
 class Jwt(models.Model):
     user = models.OneToOneField(
         CustomUser, related_name="login_user", on_delete=models.CASCADE)
-    access = models.TextField()
-    refresh = models.TextField()
+    # sha256 of the tokens, sessions are looked up by digest and the tokens
+    # themselves are never stored
+    access_digest = models.CharField(max_length=64, unique=True)
+    refresh_digest = models.CharField(max_length=64, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def get_digest(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).hexdigest()
+
+
+class RevokedToken(models.Model):
+    jti = models.CharField(max_length=64, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.utils import timezone
+
+
+class BloomFilter:
+
+    def __init__(self, bits, hashes=4):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+# revoked access token ids (jti) with the time their token expires anyway;
+# loaded from RevokedToken on first use and topped up every
+# TOKEN_DENYLIST_SYNC_INTERVAL seconds so revocations made by other workers
+# are picked up
+class TokenDenylist:
+
+    def __init__(self, sync_interval=None, bloom_bits=None):
+        self.sync_interval = sync_interval if sync_interval is not None else getattr(
+            settings, "TOKEN_DENYLIST_SYNC_INTERVAL", 30)
+        self.bloom_bits = bloom_bits if bloom_bits is not None else getattr(
+            settings, "TOKEN_DENYLIST_BLOOM_BITS", 0)
+        self._entries = {}
+        self._bloom = None
+        self._synced_at = None
+        self._next_sync = 0
+        self._lock = threading.Lock()
+
+    def is_revoked(self, jti):
+        if not jti:
+            return False
+        if time.monotonic() >= self._next_sync:
+            self.sync()
+
+        # most tokens were never revoked, the bloom filter answers those
+        # without touching the dict
+        bloom = self._bloom
+        if bloom is not None and jti not in bloom:
+            return False
+        expires = self._entries.get(jti)
+        return expires is not None and expires > datetime.now().timestamp()
+
+    def revoke(self, jti, exp):
+        from .models import RevokedToken
+        if not jti:
+            return
+        RevokedToken.objects.get_or_create(jti=jti, defaults={
+            "expires_at": datetime.fromtimestamp(exp, timezone.utc)})
+        self.add(jti, exp)
+
+    def add(self, jti, exp):
+        with self._lock:
+            self._entries[jti] = exp
+            if self._bloom is not None:
+                self._bloom.add(jti)
+
+    def sync(self):
+        from .models import RevokedToken
+        now = timezone.now()
+        with self._lock:
+            if time.monotonic() < self._next_sync:
+                return
+            self._next_sync = time.monotonic() + self.sync_interval
+            synced_at = self._synced_at
+
+        rows = RevokedToken.objects.filter(expires_at__gt=now)
+        if synced_at is not None:
+            # overlap a little so rows committed late are not missed
+            rows = rows.filter(created_at__gte=synced_at - timedelta(seconds=5))
+        else:
+            # full load when the worker starts, expired rows are useless
+            RevokedToken.objects.filter(expires_at__lte=now).delete()
+
+        with self._lock:
+            for jti, expires_at in rows.values_list("jti", "expires_at"):
+                self._entries[jti] = expires_at.timestamp()
+            self._synced_at = now
+
+            # drop what expired and rebuild the filter from what is left
+            cutoff = now.timestamp()
+            self._entries = {jti: exp for jti, exp in self._entries.items()
+                             if exp > cutoff}
+            if self.bloom_bits:
+                self._bloom = BloomFilter(self.bloom_bits)
+                for jti in self._entries:
+                    self._bloom.add(jti)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._bloom = None
+            self._synced_at = None
+            self._next_sync = 0
+
+
+token_denylist = TokenDenylist()
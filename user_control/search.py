@@ -0,0 +1,42 @@
+from chatapi.fts import FullTextIndex
+from .models import UserProfile
+
+profile_index = FullTextIndex(
+    "user_control_profile_search",
+    ("username", "first_name", "last_name", "email"))
+
+
+def get_profile_document(profile):
+    return {
+        "username": profile.user.username,
+        "first_name": profile.first_name,
+        "last_name": profile.last_name,
+        "email": profile.user.email,
+    }
+
+
+def index_profiles(profiles):
+    if not profile_index.is_available():
+        return
+    profile_index.upsert_many(
+        (profile.id, get_profile_document(profile)) for profile in profiles)
+
+
+def unindex_profile(profile_id):
+    if profile_index.is_available():
+        profile_index.delete(profile_id)
+
+
+def iter_profile_chunks(chunk_size):
+    last_id = 0
+    while True:
+        chunk = list(UserProfile.objects.select_related("user").filter(
+            id__gt=last_id).order_by("id")[:chunk_size])
+        if not chunk:
+            return
+        yield [(profile.id, get_profile_document(profile)) for profile in chunk]
+        last_id = chunk[-1].id
+
+
+def rebuild_profile_index(chunk_size=1000):
+    return profile_index.rebuild(iter_profile_chunks(chunk_size))
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import UserProfile, CustomUser, Favorite
+from message_control.media_urls import prefetch_urls
 from message_control.serializers import GenericFileUploadSerializer
 
 
@@ -25,6 +26,14 @@ class CustomUserSerializer(serializers.ModelSerializer):
         exclude = ("password", )
 
 
+class UserProfileListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        profiles = list(data.all() if hasattr(data, "all") else data)
+        prefetch_urls([profile.profile_picture for profile in profiles])
+        return super().to_representation(profiles)
+
+
 class UserProfileSerializer(serializers.ModelSerializer):
     user = CustomUserSerializer(read_only=True)
     user_id = serializers.IntegerField(write_only=True)
@@ -35,19 +44,22 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UserProfile
-        fields = "__all__"
+        exclude = ("version", )
+        list_serializer_class = UserProfileListSerializer
 
     def get_message_count(self, obj):
+        # filled in by batched list serializers and annotated querysets
+        unread_count = getattr(obj, "unread_count", None)
+        if unread_count is not None:
+            return unread_count
+
         try:
             user_id = self.context["request"].user.id
         except Exception as e:
             user_id = None
 
-        from message_control.models import Message
-        message = Message.objects.filter(
-            sender_id=obj.user.id, receiver_id=user_id, is_read=False).distinct()
-
-        return message.count()
+        from message_control.models import UnreadCounter
+        return UnreadCounter.counts(user_id, [obj.user_id]).get(obj.user_id, 0)
 
 
 class FavoriteSerializer(serializers.Serializer):
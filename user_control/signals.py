@@ -0,0 +1,58 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .models import CustomUser, UserProfile
+from .cache import principal_cache
+from .search import index_profiles, unindex_profile
+from message_control.models import GenericFileUpload
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_principal(sender, instance, **kwargs):
+    principal_cache.invalidate_user(instance.id)
+
+
+@receiver(post_save, sender=CustomUser)
+def reindex_user_profile(sender, instance, created, **kwargs):
+    # username and email are part of the profile search document
+    if not created:
+        index_profiles(
+            UserProfile.objects.select_related("user").filter(user=instance))
+
+
+@receiver(post_save, sender=CustomUser)
+def bump_user_profile(sender, instance, created, **kwargs):
+    # the user is embedded in the profile payload
+    if not created:
+        UserProfile.bump([instance.id])
+
+
+@receiver(post_save, sender=UserProfile)
+def index_profile(sender, instance, **kwargs):
+    index_profiles([instance])
+
+
+@receiver(post_delete, sender=UserProfile)
+def unindex_deleted_profile(sender, instance, **kwargs):
+    unindex_profile(instance.id)
+
+
+@receiver(pre_save, sender=UserProfile)
+def remember_profile_picture(sender, instance, **kwargs):
+    instance._previous_picture_id = UserProfile.objects.filter(
+        pk=instance.pk).values_list("profile_picture_id", flat=True).first() if instance.pk else None
+
+
+@receiver(post_save, sender=UserProfile)
+def reference_profile_picture(sender, instance, **kwargs):
+    # profile pictures count as references to their upload, like attachments
+    previous = getattr(instance, "_previous_picture_id", None)
+    if previous != instance.profile_picture_id:
+        if instance.profile_picture_id:
+            GenericFileUpload.add_references([instance.profile_picture_id])
+        GenericFileUpload.release([previous])
+
+
+@receiver(post_delete, sender=UserProfile)
+def release_profile_picture(sender, instance, **kwargs):
+    GenericFileUpload.release([instance.profile_picture_id])
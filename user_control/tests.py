@@ -1,7 +1,18 @@
 from rest_framework.test import APITestCase
-from .models import CustomUser, UserProfile
+from .models import CustomUser, UserProfile, Favorite, Jwt
+from message_control.models import Message
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from .views import get_random, get_access_token, get_refresh_token
+from .cache import principal_cache, PrincipalCache
+from .revocation import TokenDenylist, BloomFilter
+from .authentication import Authentication
+from datetime import datetime, timedelta
+from django.utils import timezone
+from chatapi.presence import PresenceBuffer
 from message_control.tests import create_image, SimpleUploadedFile
+from unittest import mock
+import threading
 
 
 class TestGenericFunctions(APITestCase):
@@ -103,6 +114,31 @@ class TestAuth(APITestCase):
         self.assertTrue(result["access"])
         self.assertTrue(result["refresh"])
 
+    def test_sessions_store_token_digests(self):
+        payload = {
+            "username": "ekrem12",
+            "password": "ekrm123",
+            "email": "ekrem12@yahoo.com"
+        }
+        self.client.post(self.register_url, data=payload)
+        self.client.post(self.login_url, data=payload)
+        refresh = self.client.post(
+            self.login_url, data=payload).json()["refresh"]
+
+        # logging in again replaces the session
+        session = Jwt.objects.get()
+        self.assertEqual(session.refresh_digest, Jwt.get_digest(refresh))
+        self.assertEqual(len(session.refresh_digest), 64)
+
+        response = self.client.post(
+            self.refresh_url, data={"refresh": refresh})
+        self.assertEqual(response.status_code, 200)
+
+        # a refresh token can only be used once
+        response = self.client.post(
+            self.refresh_url, data={"refresh": refresh})
+        self.assertEqual(response.status_code, 400)
+
 
 class TestUserInfo(APITestCase):
     profile_url = "/user/profile"
@@ -250,3 +286,304 @@ class TestUserInfo(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]["user"]["username"], "tester")
+
+    def search(self, keyword):
+        response = self.client.get(
+            self.profile_url + f"?keyword={keyword}", **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        return [r["user"]["username"] for r in response.json()["results"]]
+
+    def test_user_search_index(self):
+        user2 = CustomUser.objects._create_user(
+            username="tester", password="tester123", email="ekrem13@yahoo.com")
+        profile2 = UserProfile.objects.create(user=user2, first_name="Vester", last_name="Mango",
+                                              caption="it's all about testing", about="I'm a youtuber")
+        user3 = CustomUser.objects._create_user(
+            username="vasman", password="vasman123", email="boseman@yahoo.com")
+        UserProfile.objects.create(user=user3, first_name="Adeyemi", last_name="Boseman",
+                                   caption="it's all about testing", about="I'm a youtuber")
+
+        self.assertEqual(self.search("ekr"), ["tester"])
+        self.assertEqual(self.search("VESTER"), ["tester"])
+        # vasman matches "man" in three fields and ranks first
+        self.assertEqual(self.search("yahoo man"), ["vasman", "tester"])
+        self.assertEqual(self.search('"adeyemi bos"'), [])
+        self.assertEqual(self.search('"boseman@yahoo"'), ["vasman"])
+
+        # terms too short for the index fall back to icontains
+        self.assertEqual(self.search("ves"), ["tester"])
+        self.assertEqual(self.search("ve"), ["tester"])
+
+        # the index follows profile and user updates
+        profile2.first_name = "Renamed"
+        profile2.save()
+        user3.username = "vester"
+        user3.save()
+        self.assertEqual(self.search("vester"), ["vester"])
+
+        profile2.delete()
+        self.assertEqual(self.search("ekr"), [])
+
+    def test_user_search_without_index_support(self):
+        from chatapi import fts
+        from message_control.search import message_index
+        from user_control.search import profile_index
+
+        user2 = CustomUser.objects._create_user(
+            username="tester", password="tester123", email="ekrem13@yahoo.com")
+        UserProfile.objects.create(user=user2, first_name="Vester", last_name="Mango",
+                                   caption="it's all about testing", about="I'm a youtuber")
+
+        # SQLite older than 3.34 has FTS5 but no trigram tokenizer
+        with mock.patch("sqlite3.sqlite_version_info", (3, 31, 1)):
+            self.assertFalse(profile_index.is_available())
+            self.assertTrue(message_index.is_available())
+            self.assertEqual(self.search("ekr"), ["tester"])
+
+        with mock.patch.dict(fts._fts5_support, {connection.alias: False}):
+            self.assertFalse(profile_index.is_available())
+            self.assertFalse(message_index.is_available())
+            self.assertEqual(self.search("vester"), ["tester"])
+
+    def test_rebuild_profile_search(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        UserProfile.objects.create(user=self.user, first_name="Ekrem", last_name="Sarı",
+                                   caption="live is all about living", about="I'm a youtuber")
+        out = StringIO()
+        call_command("rebuild_profile_search", stdout=out)
+
+        self.assertIn("indexed 1 profiles", out.getvalue())
+
+    def create_peers(self, start, count):
+        for i in range(start, start + count):
+            peer = CustomUser.objects._create_user(
+                username=f"peer{i}", password="peer123", email=f"peer{i}@yahoo.com")
+            UserProfile.objects.create(user=peer, first_name="Peer", last_name=f"{i}",
+                                       caption="peer", about="peer")
+            Message.objects.create(sender=peer, receiver=self.user, message="hi")
+            Message.objects.create(sender=peer, receiver=self.user, message="hey")
+
+    def get_profile_queries(self):
+        # warm up auth caches so only the page itself is measured
+        self.client.get(self.profile_url, **self.bearer)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.profile_url, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"], len(queries)
+
+    def test_profile_list_unread_counts(self):
+        Favorite.objects.create(user=self.user)
+
+        self.create_peers(0, 2)
+        results, small_page = self.get_profile_queries()
+        self.assertEqual(len(results), 2)
+
+        self.create_peers(2, 8)
+        results, full_page = self.get_profile_queries()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(small_page, full_page)
+        self.assertEqual([r["message_count"] for r in results], [2] * 10)
+
+
+    def test_profile_etag(self):
+        Favorite.objects.create(user=self.user)
+        peer = CustomUser.objects._create_user("peer", "peer123", email="peer@yahoo.com")
+        profile = UserProfile.objects.create(
+            user=peer, first_name="peer", last_name="peer", caption="peer", about="peer")
+        url = self.profile_url + f"/{profile.id}"
+
+        response = self.client.get(url, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if "user_control_userprofile" in query["sql"]]), 1)
+
+        # a new message changes the unread count shown to this viewer
+        Message.objects.create(sender=peer, receiver=self.user, message="hi")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["message_count"], 1)
+        etag = response["ETag"]
+
+        profile.caption = "changed"
+        profile.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.json()["caption"], "changed")
+
+    def test_me_etag(self):
+        response = self.client.post(self.profile_url, data={
+            "user_id": self.user.id, "first_name": "Ekrem", "last_name": "Sarı",
+            "caption": "caption", "about": "about"}, **self.bearer)
+        profile_id = response.json()["id"]
+
+        etag = self.client.get("/user/me", **self.bearer)["ETag"]
+        response = self.client.get("/user/me", HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.status_code, 304)
+
+        self.client.patch(self.profile_url + f"/{profile_id}", data={
+            "first_name": "Z.Ekrem"}, **self.bearer)
+        response = self.client.get("/user/me", HTTP_IF_NONE_MATCH=etag, **self.bearer)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["first_name"], "Z.Ekrem")
+
+
+class TestPrincipalCache(APITestCase):
+    login_url = "/user/login"
+    me_url = "/user/me"
+    logout_url = "/user/logout"
+
+    def setUp(self):
+        payload = {
+            "username": "cached",
+            "password": "cached123",
+            "email": "cached@yahoo.com"
+        }
+        self.user = CustomUser.objects._create_user(**payload)
+        principal_cache.clear()
+
+        response = self.client.post(self.login_url, data=payload)
+        self.bearer = {
+            'HTTP_AUTHORIZATION': 'Bearer {}'.format(response.json()['access'])}
+
+    def test_repeated_requests_hit_cache(self):
+        self.client.get(self.me_url, **self.bearer)
+        response = self.client.get(self.me_url, **self.bearer)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["user"]["id"], self.user.id)
+        self.assertEqual(principal_cache.stats()["misses"], 1)
+        self.assertEqual(principal_cache.stats()["hits"], 1)
+
+    def test_save_and_logout_invalidate(self):
+        self.client.get(self.me_url, **self.bearer)
+        self.assertEqual(principal_cache.stats()["size"], 1)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(principal_cache.stats()["size"], 0)
+
+        self.user.is_active = True
+        self.user.save()
+        self.client.get(self.me_url, **self.bearer)
+        self.client.get(self.logout_url, **self.bearer)
+        self.assertEqual(principal_cache.stats()["size"], 0)
+
+    def test_lru_eviction_and_expiry(self):
+        cache = PrincipalCache(max_size=2, ttl=60)
+        now = datetime.now().timestamp()
+
+        cache.set("a", self.user, now + 60)
+        cache.set("b", self.user, now + 60)
+        cache.get("a")
+        cache.set("c", self.user, now + 60)
+
+        # b was least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").id, self.user.id)
+
+        # ttl is capped by the token expiry
+        cache.set("d", self.user, now - 1)
+        self.assertIsNone(cache.get("d"))
+
+    def test_revocation_checked_outside_lock(self):
+        cache = PrincipalCache(max_size=2, ttl=60)
+        cache.set("a", self.user, datetime.now().timestamp() + 60, jti="revoked")
+
+        def is_revoked(jti):
+            self.assertFalse(cache._lock.locked())
+            return True
+
+        with mock.patch("user_control.cache.token_denylist.is_revoked", side_effect=is_revoked):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+
+class TestTokenRevocation(APITestCase):
+    login_url = "/user/login"
+    me_url = "/user/me"
+    logout_url = "/user/logout"
+
+    def setUp(self):
+        payload = {
+            "username": "revoked",
+            "password": "revoked123",
+            "email": "revoked@yahoo.com"
+        }
+        CustomUser.objects._create_user(**payload)
+        response = self.client.post(self.login_url, data=payload)
+        self.access = response.json()['access']
+        self.bearer = {'HTTP_AUTHORIZATION': 'Bearer {}'.format(self.access)}
+
+    def test_logout_revokes_access_token(self):
+        self.assertEqual(self.client.get(
+            self.me_url, **self.bearer).status_code, 200)
+        jti = Authentication.verify_token(self.access)["jti"]
+
+        self.client.get(self.logout_url, **self.bearer)
+
+        self.assertEqual(self.client.get(
+            self.me_url, **self.bearer).status_code, 403)
+        self.assertIsNone(Authentication.verify_token(self.access))
+
+        # a worker starting later rebuilds the denylist from the database
+        denylist = TokenDenylist(bloom_bits=1024)
+        self.assertTrue(denylist.is_revoked(jti))
+        self.assertFalse(denylist.is_revoked("not-revoked"))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1024)
+        for i in range(20):
+            bloom.add(f"jti-{i}")
+
+        self.assertTrue(all(f"jti-{i}" in bloom for i in range(20)))
+        self.assertLess(sum(f"other-{i}" in bloom for i in range(200)), 10)
+
+
+class TestPresenceBuffer(APITestCase):
+
+    def setUp(self):
+        self.long_ago = timezone.now() - timedelta(days=1)
+        self.users = [
+            CustomUser.objects._create_user(
+                f"present{i}", "present123", email=f"present{i}@yahoo.com",
+                is_online=self.long_ago)
+            for i in range(3)
+        ]
+
+    def test_flush_on_size(self):
+        buffer = PresenceBuffer(interval=3600, max_users=3)
+
+        buffer.record(self.users[0].id)
+        buffer.record(self.users[1].id)
+        self.users[0].refresh_from_db()
+        self.assertEqual(self.users[0].is_online, self.long_ago)
+
+        with self.assertNumQueries(1):
+            buffer.record(self.users[2].id)
+
+        for user in self.users:
+            user.refresh_from_db()
+            self.assertGreater(user.is_online, self.long_ago)
+        self.assertEqual(buffer.pending(), {})
+
+    def test_background_flush(self):
+        buffer = PresenceBuffer(interval=0.01, max_users=100)
+        flushed = threading.Event()
+        with mock.patch.object(buffer, "flush", side_effect=lambda: flushed.set()):
+            buffer.start()
+            self.assertTrue(flushed.wait(5))
+            buffer.stop()
+        self.assertIsNone(buffer._thread)
+
+    def test_flush_on_interval(self):
+        buffer = PresenceBuffer(interval=0, max_users=100)
+        buffer.record(self.users[0].id)
+
+        self.users[0].refresh_from_db()
+        self.assertGreater(self.users[0].is_online, self.long_ago)
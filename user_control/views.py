@@ -1,19 +1,26 @@
 import jwt
 from .models import Jwt, CustomUser, UserProfile, Favorite
+from message_control.models import Conversation, UnreadCounter
 from datetime import datetime, timedelta
 from django.conf import settings
 import random
 import string
+import uuid
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 from .serializers import LoginSerializer, RegisterSerializer, RefreshSerializer, UserProfileSerializer, FavoriteSerializer
 from django.contrib.auth import authenticate
 from rest_framework.response import Response
 from .authentication import Authentication
+from .cache import principal_cache
+from .revocation import token_denylist
 # from rest_framework.permissions import IsAuthenticated
+from chatapi.conditional import conditional, make_etag
 from chatapi.custom_auth_permission import IsAuthenticatedCustom
 import re
 from django.db.models import Q, Count, Subquery, OuterRef
+from django.db.models.expressions import RawSQL
+from .search import profile_index
 
 
 def get_random(length):
@@ -22,7 +29,8 @@ def get_random(length):
 
 def get_access_token(payload):
     return jwt.encode(
-        {"exp": datetime.now() + timedelta(minutes=55), **payload},
+        {"exp": datetime.now() + timedelta(minutes=55),
+         "jti": uuid.uuid4().hex, **payload},
         settings.SECRET_KEY,
         algorithm="HS256"
     )
@@ -41,12 +49,20 @@ def decodeJWT(bearer):
         return None
 
     token = bearer[7:]
+    user = principal_cache.get(token)
+    if user:
+        return user
+
     decoded = jwt.decode(token, key=settings.SECRET_KEY)
     if decoded:
+        if token_denylist.is_revoked(decoded.get("jti")):
+            return None
         try:
-            return CustomUser.objects.get(id=decoded["user_id"])
+            user = CustomUser.objects.get(id=decoded["user_id"])
         except Exception:
             return None
+        principal_cache.set(token, user, decoded["exp"], decoded.get("jti"))
+        return user
 
 
 class LoginView(APIView):
@@ -63,14 +79,13 @@ class LoginView(APIView):
         if not user:
             return Response({"error": "Invalid username or password"}, status="400")
 
-        Jwt.objects.filter(user_id=user.id).delete()
-
         access = get_access_token({"user_id": user.id})
         refresh = get_refresh_token()
 
-        Jwt.objects.create(
-            user_id=user.id, access=access.decode(), refresh=refresh.decode()
-        )
+        Jwt.objects.update_or_create(user_id=user.id, defaults={
+            "access_digest": Jwt.get_digest(access),
+            "refresh_digest": Jwt.get_digest(refresh),
+        })
 
         return Response({"access": access, "refresh": refresh})
 
@@ -99,43 +114,82 @@ class RefreshView(APIView):
 
         try:
             active_jwt = Jwt.objects.get(
-                refresh=serializer.validated_data["refresh"])
+                refresh_digest=Jwt.get_digest(serializer.validated_data["refresh"]))
         except Jwt.DoesNotExist:
             return Response({"error": "refresh token not found"}, status="400")
         if not Authentication.verify_token(serializer.validated_data["refresh"]):
             return Response({"error": "Token is invalid or has expired"})
 
-        access = get_access_token({"user_id": active_jwt.user.id})
+        access = get_access_token({"user_id": active_jwt.user_id})
         refresh = get_refresh_token()
 
-        active_jwt.access = access.decode()
-        active_jwt.refresh = refresh.decode()
+        active_jwt.access_digest = Jwt.get_digest(access)
+        active_jwt.refresh_digest = Jwt.get_digest(refresh)
         active_jwt.save()
 
         return Response({"access": access, "refresh": refresh})
 
 
+def get_profile_etag(viewer_id, profiles, *parts):
+    # the profile's version, the one of its conversation with the viewer,
+    # which carries the unread count, and the user's presence, which is
+    # written apart from any version, in one query
+    conversations = Conversation.objects.filter(
+        Q(user_low_id=viewer_id, user_high_id=OuterRef("user_id")) |
+        Q(user_low_id=OuterRef("user_id"), user_high_id=viewer_id))
+    versions = profiles.annotate(conversation_version=Subquery(
+        conversations.values("version")[:1])
+    ).values_list("id", "version", "conversation_version", "user__is_online").first()
+    if versions is None:
+        return None
+    return make_etag("profile", viewer_id, versions, *parts)
+
+
 class UserProfileView(ModelViewSet):
     queryset = UserProfile.objects.all()
     serializer_class = UserProfileSerializer
     permission_classes = (IsAuthenticatedCustom, )
 
+    def retrieve(self, request, *args, **kwargs):
+        etag = get_profile_etag(
+            request.user.id, UserProfile.objects.filter(pk=kwargs["pk"]),
+            sorted(request.query_params.items()))
+        return conditional(request, etag, lambda: super(
+            UserProfileView, self).retrieve(request, *args, **kwargs))
+
     def get_queryset(self):
         if self.request.method.lower() != "get":
             return self.queryset
 
+        queryset = self.queryset.select_related(
+            "user", "profile_picture"
+        ).prefetch_related(
+            "user__groups", "user__user_permissions"
+        ).annotate(
+            unread_count=UnreadCounter.count_subquery(
+                self.request.user.id, OuterRef("user_id"))
+        )
+
         data = self.request.query_params.dict()
         data.pop("page", None)
         keyword = data.pop("keyword", None)
         print(data)
 
         if keyword:
+            terms = self.normalize_query(keyword)
+            if profile_index.can_search(terms):
+                queryset = self.search_queryset(queryset, terms)
+                return queryset.filter(**data).exclude(
+                    Q(user_id=self.request.user.id) |
+                    Q(user__is_superuser=True)
+                )
+
             search_fields = (
                 "user__username", "first_name", "last_name", "user__email"
             )
             query = self.get_query(keyword, search_fields)
             try:
-                return self.queryset.filter(query).filter(**data).exclude(
+                return queryset.filter(query).filter(**data).exclude(
                     Q(user_id=self.request.user.id) |
                     Q(user__is_superuser=True)
                 )
@@ -144,7 +198,7 @@ class UserProfileView(ModelViewSet):
 
         print(self.request.user.user_favorites
               )
-        result = self.queryset.filter(**data).exclude(
+        result = queryset.filter(**data).exclude(
             Q(user_id=self.request.user.id) |
             Q(user__is_superuser=True)
         )
@@ -159,6 +213,19 @@ class UserProfileView(ModelViewSet):
         except Exception:
             return []
 
+    @staticmethod
+    def search_queryset(queryset, terms):
+        # ranked lookup in the full-text index, same matching rules as
+        # get_query: every term must appear in one of the indexed fields
+        match = profile_index.match_query(terms)
+        rank = profile_index.rank_sql(
+            f'"{UserProfile._meta.db_table}"."id"')
+        return queryset.filter(
+            id__in=RawSQL(profile_index.rowids_sql(), [match])
+        ).annotate(
+            search_rank=RawSQL(rank, [match])
+        ).order_by("search_rank", "created_at")
+
     @staticmethod
     def get_query(query_string, search_fields):
         query = None  # Query to search for every search term
@@ -187,6 +254,11 @@ class MeView(APIView):
     serializer_class = UserProfileSerializer
 
     def get(self, request):
+        etag = get_profile_etag(
+            request.user.id, UserProfile.objects.filter(user_id=request.user.id))
+        return conditional(request, etag, lambda: self.respond(request))
+
+    def respond(self, request):
         data = {}
         try:
             data = self.serializer_class(request.user.user_profile).data
@@ -206,6 +278,13 @@ class LogoutView(APIView):
         user_id = request.user.id
 
         Jwt.objects.filter(user_id=user_id).delete()
+        principal_cache.invalidate_user(user_id)
+
+        # the access token stays valid until it expires unless revoked
+        decoded = Authentication.verify_token(
+            request.META.get("HTTP_AUTHORIZATION", "")[7:])
+        if decoded:
+            token_denylist.revoke(decoded.get("jti"), decoded["exp"])
 
         return Response("logged out successfully", status=200)
 